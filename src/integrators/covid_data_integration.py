@@ -1,9 +1,14 @@
 import pandas as pd 
+import numpy as np
 import argparse
 import gzip
+import hashlib
 import json
 import requests
-from os import listdir
+import sqlite3
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os import listdir, makedirs, stat
 from os.path import isfile, join
 
 # 
@@ -12,17 +17,20 @@ from os.path import isfile, join
 This script integrates all COVID-19 related datasets into a single table
 """
 
-def fetch_organism(tax_ids=[]):
+def fetch_organism(tax_ids=[], workers=8):
     base_url = 'https://www.ebi.ac.uk/ena/data/taxonomy/v1/taxon/tax-id/'
-    return_data = []
 
-    for tax_id in tax_ids:
+    def fetch(tax_id):
         try:
-            return_data.append(requests.get(base_url+str(tax_id)).json())
+            return requests.get(base_url+str(tax_id), timeout=30).json()
         except Exception as e:
             print(e)
             print('[Error] Failed to fetch organism data.')
 
+    # The requests are sent concurrently:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return_data = [x for x in executor.map(fetch, tax_ids) if x is not None]
+
     # Get all unique species:
     try:
         df = pd.DataFrame(return_data)
@@ -32,43 +40,395 @@ def fetch_organism(tax_ids=[]):
         return None
 
 
+def get_file_hash(filename):
+    """
+    Returns the sha1 hash of the file content
+    """
+    file_hash = hashlib.sha1()
+
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+
+def join_exploded_values(exploded, sep=','):
+    """
+    Joining exploded values back into strings by index.
+    In the n-th pass the n-th value of every index is appended, so the number of passes
+    is the length of the longest list.
+    """
+    if len(exploded) == 0:
+        return exploded
+
+    position = exploded.groupby(level=0).cumcount().values
+    joined = exploded[position == 0].copy()
+
+    for n in range(1, position.max() + 1):
+        nth_values = exploded[position == n]
+        joined.loc[nth_values.index] = joined.loc[nth_values.index] + sep + nth_values
+
+    return joined
+
+
+def get_json_columns(data_df, columns):
+    """
+    Returns the columns that look like json arrays (any of the values starts with '[')
+    """
+    return [column for column in columns if data_df[column].astype('str').str.match(r'\[').any()]
+
+
+def get_joined_columns(data_df, parameters):
+    """
+    Returns the columns of the data joined to the table: the listed columns and the flag column
+    """
+    columns = list(parameters['columns']) if 'columns' in parameters else []
+
+    # The flag column is added to the data if missing:
+    flag_label = parameters.get('flag_label') if parameters.get('flag') else None
+    if flag_label:
+        columns.append(flag_label)
+
+    joined_columns = [x for x in data_df.columns if x in columns and x != 'id']
+    if flag_label and flag_label not in data_df.columns:
+        joined_columns.append(flag_label)
+
+    return joined_columns
+
+
+def decode_json_values(values):
+    """
+    Loads lists from json formatted strings. Values are decoded only once for all repeated occurrences.
+    Values not looking like a json array or failing to decode are kept as they are.
+    """
+    codes, uniques = pd.factorize(values)
+
+    decoded = np.empty(len(uniques) + 1, dtype=object)
+    for i, value in enumerate(uniques):
+        decoded[i] = value
+        if '[' in str(value):
+            try:
+                decoded[i] = json.loads(value)
+            except ValueError:
+                pass
+
+    # Missing values (code -1) are picked up from the last position:
+    decoded[-1] = np.nan
+
+    return pd.Series(decoded[codes], index=values.index, name=values.name)
+
+
+def read_reference_table(ensemblFile):
+    """
+    Reading the parsed ensembl data either from the pickled or Feather table or from the compressed json file
+    """
+    if ensemblFile.endswith('.pkl'):
+        return pd.read_pickle(ensemblFile)
+    if ensemblFile.endswith('.feather'):
+        return pd.read_feather(ensemblFile)
+
+    # loading ensembl file (compressed json):
+    with gzip.open(ensemblFile,'rt') as f:
+        return pd.DataFrame([json.loads(line) for line in f])
+
+
+def read_preformatted_file(input_folder, preformatted_file):
+    """
+    Reading a preformatted table and checking its id column
+    """
+
+    # try open file:
+    try:
+        data_df = pd.read_csv('{}/{}'.format(input_folder, preformatted_file), sep='\t')
+    except:
+        print('[Error] Could not open {} as tsv.'.format(preformatted_file))
+        raise
+
+    # Testing if table has id:
+    if 'id' not in data_df.columns.tolist():
+        raise ValueError('The table must have \'id\' column to join.')
+
+    # Skipping data if the id column is not unique:
+    if len(data_df) != len(data_df['id'].unique()):
+        print('[Warning] The \'id\' column in {} file is not unique!'.format(preformatted_file))
+
+    return data_df
+
+
+class IntegrationState(object):
+    """
+    Keeps the fingerprints of the integrated files and the integrated table of the last run
+    (before the target specific post-processing), so when only some of the sources change,
+    just the columns contributed by those sources have to be recomputed.
+
+    Only sources that are left joined on a unique id, don't map values into existing columns
+    and don't share column names with other sources (those columns are suffixed in the table)
+    can be patched into the stored table, any other change requires a full rebuild.
+    """
+
+    def __init__(self, state_folder):
+        self.state_file = join(state_folder, 'integration_state.json')
+        self.snapshot_file = join(state_folder, 'integrated_snapshot.pkl')
+        makedirs(state_folder, exist_ok=True)
+
+        # Loading state of the previous run:
+        if isfile(self.state_file) and isfile(self.snapshot_file):
+            with open(self.state_file, 'rt') as f:
+                self.previous = json.load(f)
+        else:
+            self.previous = None
+
+    @staticmethod
+    def is_patchable(data_df, parameters):
+        """
+        Returns True if the data of the source can be patched into an existing integrated table.
+        """
+        return (
+            parameters.get('how', 'left') == 'left' and
+            not parameters.get('columns_to_map') and
+            data_df['id'].is_unique
+        )
+
+    @staticmethod
+    def get_clashing_columns(column_lists):
+        """
+        Returns the columns present in more than one of the lists.
+        """
+        counts = Counter(column for columns in column_lists for column in set(columns))
+        return {column for column, count in counts.items() if count > 1}
+
+    def get_changed_sources(self, fingerprints):
+        """
+        Comparing the fingerprints with the ones of the previous run.
+
+        Returns a tuple with the list of changed (or new) and removed sources.
+        If the previous table cannot be updated, None is returned.
+        """
+        if self.previous is None or 'json_columns' not in self.previous:
+            return None
+
+        # Changes in the reference or in the integration config requires a full rebuild:
+        if (self.previous['reference'] != fingerprints['reference'] or
+                self.previous['config'] != fingerprints['config']):
+            return None
+
+        previous_sources = self.previous['sources']
+        changed = [source for source, fingerprint in fingerprints['sources'].items()
+                   if source not in previous_sources or previous_sources[source]['fingerprint'] != fingerprint]
+        removed = [source for source in previous_sources if source not in fingerprints['sources']]
+
+        # The data of the changed or removed sources has to be removed from the table:
+        for source in changed + removed:
+            if source in previous_sources and not previous_sources[source]['patchable']:
+                return None
+
+        return changed, removed
+
+    def load_snapshot(self):
+        return pd.read_pickle(self.snapshot_file)
+
+    def save(self, integrated_df, fingerprints, reference_columns, json_columns, sources):
+        """
+        Saving the integrated table and the fingerprints and columns of the sources.
+        """
+        integrated_df.to_pickle(self.snapshot_file)
+
+        state = {
+            'reference': fingerprints['reference'],
+            'config': fingerprints['config'],
+            'reference_columns': reference_columns,
+            'json_columns': sorted(json_columns),
+            'sources': {source: dict(fingerprint=fingerprints['sources'][source], **sources[source]) for source in sources}
+        }
+        with open(self.state_file, 'wt') as f:
+            json.dump(state, f, indent=2)
+
+
+class TaxonomyResolver(object):
+    """
+    Maps taxonomy identifiers to scientific names.
+
+    The names are looked up in an in-memory LRU cache first, then in a local SQLite store
+    that can be populated from the NCBI taxonomy names dump (names.dmp). Identifiers not
+    found locally are only fetched from ENA if remote lookups are enabled, the fetched
+    names are then saved in the store for the next runs.
+    """
+
+    def __init__(self, store_file=None, names_dump=None, remote=False, cache_size=1024, workers=8):
+        self.remote = remote
+        self.workers = workers
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.store = None
+
+        if store_file:
+            self.store = sqlite3.connect(store_file)
+            self.store.execute('CREATE TABLE IF NOT EXISTS taxonomy (tax_id INTEGER PRIMARY KEY, scientific_name TEXT)')
+            self.store.execute('CREATE TABLE IF NOT EXISTS source (name TEXT PRIMARY KEY, fingerprint TEXT)')
+
+            if names_dump:
+                self.load_names_dump(names_dump)
+
+    def load_names_dump(self, names_dump):
+        """
+        Loading the scientific names from the NCBI dump into the store, unless the same dump was already loaded.
+        """
+        file_stat = stat(names_dump)
+        fingerprint = '{}-{}'.format(file_stat.st_size, file_stat.st_mtime_ns)
+
+        loaded = self.store.execute('SELECT fingerprint FROM source WHERE name = ?', ('names_dump',)).fetchone()
+        if loaded and loaded[0] == fingerprint:
+            return
+
+        print('[Info] Loading taxonomy names from {}'.format(names_dump))
+
+        # Each row looks like: tax_id\t|\tname_txt\t|\tunique_name\t|\tname_class\t|
+        with self.store, open(names_dump, 'rt') as f:
+            rows = (line.split('\t|\t') for line in f)
+            self.store.executemany(
+                'INSERT OR REPLACE INTO taxonomy VALUES (?, ?)',
+                ((int(row[0]), row[1]) for row in rows if row[3].startswith('scientific name'))
+            )
+            self.store.execute('INSERT OR REPLACE INTO source VALUES (?, ?)', ('names_dump', fingerprint))
+
+    def query_store(self, tax_ids):
+        names = {}
+
+        # Keeping the number of query parameters under the SQLite limit:
+        for i in range(0, len(tax_ids), 500):
+            chunk = tax_ids[i:i + 500]
+            query = 'SELECT tax_id, scientific_name FROM taxonomy WHERE tax_id IN ({})'.format(','.join('?' * len(chunk)))
+            names.update(self.store.execute(query, chunk).fetchall())
+
+        return names
+
+    def fetch_remote(self, tax_ids):
+        tax_df = fetch_organism(tax_ids, self.workers)
+        if tax_df is None or len(tax_df) == 0:
+            return {}
+
+        names = dict(zip(tax_df.taxId.astype(int).tolist(), tax_df.scientificName))
+
+        # Saving the fetched names for the next runs:
+        if self.store:
+            with self.store:
+                self.store.executemany('INSERT OR REPLACE INTO taxonomy VALUES (?, ?)', names.items())
+
+        return names
+
+    def get_scientific_names(self, tax_ids):
+        """
+        Returns a dataframe with the taxId and scientificName of the resolved identifiers.
+        """
+        names = {}
+        missing = []
+
+        for tax_id in tax_ids:
+            if tax_id in self.cache:
+                self.cache.move_to_end(tax_id)
+                names[tax_id] = self.cache[tax_id]
+            else:
+                missing.append(tax_id)
+
+        if missing and self.store:
+            names.update(self.query_store(missing))
+            missing = [tax_id for tax_id in missing if tax_id not in names]
+
+        if missing and self.remote:
+            names.update(self.fetch_remote(missing))
+            missing = [tax_id for tax_id in missing if tax_id not in names]
+
+        if missing:
+            print('[Warning] Failed to resolve {} taxonomy identifiers.'.format(len(missing)))
+
+        # Updating cache:
+        for tax_id, name in names.items():
+            self.cache[tax_id] = name
+            self.cache.move_to_end(tax_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return pd.DataFrame({
+            'scientificName': list(names.values()),
+            'taxId': np.array(list(names.keys()), dtype=float)
+        })
+
+
 class TargetDataIntegrator(object):
 
     def __init__(self, ensemblFile):
-        
-        ensembl_data = []
 
-        # loading ensembl file (compressed json):
-        with gzip.open(ensemblFile,'rt') as f:
-            for line in f:
-                gene_row = json.loads(line)
-                ensembl_data.append(gene_row)
+        # Loading parsed ensembl table:
+        ensembl_df = read_reference_table(ensemblFile)
         
-        print('[Info] Readind data complete. Number of genes: {}'.format(len(ensembl_data)))
+        print('[Info] Readind data complete. Number of genes: {}'.format(len(ensembl_df)))
         print('[Info] Processing data...')
         
-        # Once data is read, we fomat into a data frame:
-        ensembl_df = pd.DataFrame(ensembl_data)
-        
         # Merging arrays:
         ensembl_df.drop(columns=['PDB'], inplace=True)
-        ensembl_df.MIM_morbidity = ensembl_df.MIM_morbidity.apply(lambda x: ','.join([y['display_id'] for y in x]) if len(x)>0 else None)
-        ensembl_df.uniprot_ids = ensembl_df.uniprot_ids.apply(lambda x: ','.join(x) if len(x) > 0 else None)
+
+        mim_ids = ensembl_df.MIM_morbidity.explode().str.get('display_id').dropna()
+        ensembl_df['MIM_morbidity'] = join_exploded_values(mim_ids).reindex(ensembl_df.index)
+
+        uniprot_ids = ensembl_df.uniprot_ids.str.join(',')
+        ensembl_df['uniprot_ids'] = uniprot_ids.where(uniprot_ids != '')
         
         self.ensembl_df = ensembl_df
+
+        # Data added to the integrator waiting to be joined:
+        self.integration_plan = []
+
+        # Columns holding json arrays:
+        self.json_columns = set()
+
+    @classmethod
+    def from_integrated_table(cls, integrated_df, json_columns=()):
+        """
+        Creating integrator object from a previously integrated table
+        """
+        integrator = cls.__new__(cls)
+        integrator.ensembl_df = integrated_df
+        integrator.integration_plan = []
+        integrator.json_columns = set(json_columns)
+
+        return integrator
+
+    def remove_columns(self, columns):
+        """
+        Removing columns added by a source
+        """
+        self.ensembl_df = self.ensembl_df.drop(columns=[column for column in columns if column in self.ensembl_df.columns])
+        self.json_columns.difference_update(columns)
+
+    def order_columns(self, column_lists):
+        """
+        Ordering columns as the lists of the reference and the sources are joined, not listed columns are moved to the end.
+        Overlapping column names are suffixed the same way as the joins do.
+        """
+        columns = []
+        for column_list in column_lists:
+            for column in column_list:
+                if column in columns:
+                    columns[columns.index(column)] = column + '_x'
+                    column = column + '_y'
+                columns.append(column)
+
+        listed = [column for column in columns if column in self.ensembl_df.columns]
+        self.ensembl_df = self.ensembl_df[listed + [column for column in self.ensembl_df.columns if column not in listed]]
         
         
     def add_data(self, data_df, parameters):
         """
-        Adding new data to the integrator
+        Adding new data to the integrator. The data is only prepared and indexed by id here,
+        all tables are joined together in a single step by integrate_data.
+
+        Returns the list of columns added by the data.
         """
         ##
         ## Checking merge parameters
         ##
         
-        # Checking columns of intereset:
-        columns = parameters['columns'] if 'columns' in parameters else []
-        
         # Check flag:
         flag = parameters['flag'] if 'flag' in parameters else False
         
@@ -76,9 +436,8 @@ class TargetDataIntegrator(object):
         if flag:  
             try:
                 flag_label = parameters['flag_label']
-                columns.append(flag_label)
-            except ValueError as e:
-                raise e('If adding flag is required, the column name has to be set (flag_label key)!')
+            except KeyError:
+                raise ValueError('If adding flag is required, the column name has to be set (flag_label key)!')
                 
         # How to join:
         how = parameters['how'] if 'how' in parameters else 'left'
@@ -94,33 +453,145 @@ class TargetDataIntegrator(object):
         if flag:
             data_df[flag_label] = True
 
-        # Renaming columns to avoid confusion:
-        protected_columns = columns.append('id')
-        column_rename_map = {x : x+'_temp' for x in data_df.columns if x not in columns}
-        data_df.rename(columns=column_rename_map, inplace=True)
+        # Only the columns of interest are joined, the rest is only used to map values to existing columns:
+        kept_columns = get_joined_columns(data_df, parameters)
 
-        ##
-        ## Join data:
-        ##
-        
-        merged = self.ensembl_df.merge(data_df, how=how, on='id')
-        self.merged = merged
-        ##
-        ## Cleaning merged data:
-        ##
+        # Columns with json arrays are either listed in the recipe or inferred from the data:
+        if 'json_columns' in parameters:
+            self.json_columns.update(x for x in parameters['json_columns'] if x in kept_columns)
+        else:
+            self.json_columns.update(get_json_columns(data_df, kept_columns))
+
+        self.integration_plan.append({
+            'data': data_df[['id'] + kept_columns],
+            'how': how,
+            'flag_label': flag_label if flag else None,
+            'columns_to_map': {col1: data_df[['id', col2]] for col1, col2 in columns_to_map.items()}
+        })
+
+        return kept_columns
+
+    def integrate_data(self):
+        """
+        Joining all added data to the table, in the order the data was added.
+
+        Consecutive data with unique ids are joined in one step by join_data. Data with non-unique
+        ids would multiply rows, so those are merged one by one, in their place in the order.
+        """
+        plan = self.integration_plan
+        self.integration_plan = []
+
+        indexed_sources = []
+        for source in plan:
+            if source['data']['id'].is_unique:
+                indexed_sources.append(source)
+                continue
+
+            self.join_data(indexed_sources)
+            indexed_sources = []
+            self.merge_data(source)
+
+        self.join_data(indexed_sources)
+
+    def join_data(self, sources):
+        """
+        Joining data with unique ids to the table in one step:
+        1. The final set of ids is derived from the join type of each data.
+        2. Each data is reindexed on the shared id index and concatenated along the columns.
+        """
+        if not sources:
+            return
+
+        # If the table itself has duplicated ids, the data is merged one by one:
+        if not self.ensembl_df['id'].is_unique:
+            for source in sources:
+                self.merge_data(source)
+            return
+
+        # Get final set of ids, keeping the ids of the table after each join:
+        index = pd.Index(self.ensembl_df['id'])
+        source_indexes = []
+        for source in sources:
+            ids = pd.Index(source['data']['id'])
+
+            if source['how'] == 'outer':
+                index = index.append(ids[~ids.isin(index)])
+            elif source['how'] == 'inner':
+                index = index[index.isin(ids)]
+            elif source['how'] == 'right':
+                index = ids
+
+            source_indexes.append(index)
+
+        # Reindexing all tables on the shared index:
+        blocks = [self.ensembl_df.set_index('id').reindex(index)]
+        for source in sources:
+            block = source['data'].set_index('id').reindex(index)
+
+            # Overlapping column names are suffixed the same way as merge does:
+            for column in block.columns:
+                for previous_block in blocks:
+                    if column in previous_block.columns:
+                        previous_block.rename(columns={column: column + '_x'}, inplace=True)
+                        block = block.rename(columns={column: column + '_y'})
+
+                        if column in self.json_columns:
+                            self.json_columns.update([column + '_x', column + '_y'])
+
+            blocks.append(block)
+
+        integrated_df = pd.concat(blocks, axis=1)
+
+        # Values are only filled in the rows the table had after joining the source, as sequential merges do.
+        # Rows added by a later outer join are left missing:
+        for source, source_index in zip(sources, source_indexes):
+            rows = index.isin(source_index)
+
+            # Mapping values from the new data:
+            for col1, map_df in source['columns_to_map'].items():
+                mapped = map_df.set_index('id').iloc[:, 0].reindex(index).where(rows)
+                integrated_df[col1] = integrated_df[col1].fillna(mapped)
+
+            # Adding false values to flag column:
+            if source['flag_label']:
+                flags = integrated_df[source['flag_label']]
+                if rows.all():
+                    integrated_df[source['flag_label']] = flags.fillna(False).astype(bool)
+                else:
+                    integrated_df[source['flag_label']] = flags.where(~rows | flags.notnull(), False)
+
+        # Restoring id column:
+        integrated_df.index.name = 'id'
+        integrated_df = integrated_df.reset_index()
+        self.ensembl_df = integrated_df[self.ensembl_df.columns.tolist() +
+                                        [x for x in integrated_df.columns if x not in self.ensembl_df.columns]]
+
+    def merge_data(self, source):
+        """
+        Merging a single data to the table
+        """
+        data_df = source['data']
+
+        # Adding columns used for mapping values:
+        for col1, map_df in source['columns_to_map'].items():
+            data_df = data_df.assign(**{col1 + '_temp': map_df.iloc[:, 1].values})
+
+        # Overlapping column names are suffixed by merge:
+        for column in data_df.columns.drop('id'):
+            if column in self.ensembl_df.columns and column in self.json_columns:
+                self.json_columns.update([column + '_x', column + '_y'])
+
+        merged = self.ensembl_df.merge(data_df, how=source['how'], on='id')
 
         # Mapping values from the new data:
-        for col1, col2 in columns_to_map.items():
-            merged[col1] = merged[col1].fillna(merged[col2+"_temp"])
-        
-        # Removing temporary columns:
-        merged.drop(list(column_rename_map.values()), axis=1, inplace=True)
-        
+        for col1 in source['columns_to_map']:
+            merged[col1] = merged[col1].fillna(merged[col1 + '_temp'])
+            merged.drop(col1 + '_temp', axis=1, inplace=True)
+
         # Adding false values to flag column:
-        if flag:
-            merged[flag_label].loc[merged[flag_label]!=True] = False
-            
-        # Update dataframe:
+        if source['flag_label']:
+            merged[source['flag_label']] = merged[source['flag_label']].fillna(False).astype(bool)
+
         self.ensembl_df = merged
         
     
@@ -149,30 +620,10 @@ class TargetDataIntegrator(object):
     def fix_json(self):
         df = self.ensembl_df
 
-        # Columns to fix format:
-        columns_to_json_load = []
-
-        # Get all columns that look like a json array:
-        for column in df.columns:
-            if df[column].astype('str').str.match('\[').any():
-                columns_to_json_load.append(column)
-                
-        # Loop through all the columns and loads list from json formatted string:
-        for col in columns_to_json_load:
-            values = []
-            
-            # Looping through all values and try to convert it a dictionary from json string if it has an array:
-            for value in df[col]:
-                if '[' in str(value):
-                    try:
-                        values.append(json.loads(value))
-                    except:
-                        values.append(value)
-                else:
-                    values.append(value)
-
-            # Update column:
-            df[col] = values
+        # Loads lists from json formatted strings in the columns holding json arrays:
+        for col in self.json_columns:
+            if col in df.columns:
+                df[col] = decode_json_values(df[col])
 
         # Update dataframe:
         self.ensembl_df = df
@@ -191,7 +642,7 @@ class TargetDataIntegrator(object):
         if '.json' in file_name:
             integrated.to_json(file_name, lines=True,orient='records',compression='infer')
 
-    def map_taxonomy(self):
+    def map_taxonomy(self, resolver):
 
         # Get a unique set of taxonomy identifiers:
         tax_ids = [int(x) for x in self.ensembl_df.taxon_id.unique() if x == x ]
@@ -199,8 +650,8 @@ class TargetDataIntegrator(object):
         if len(tax_ids) == 0:
             return
 
-        # Map IDs to taxonomy object:
-        tax_df= fetch_organism(tax_ids)
+        # Map IDs to scientific names:
+        tax_df = resolver.get_scientific_names(tax_ids)
 
         # Merging data wih taxonomy df:
         merged = self.ensembl_df.merge(tax_df[['scientificName','taxId']], left_on='taxon_id', right_on='taxId', how='left')
@@ -287,6 +738,16 @@ class DrugDataIntegrator(object):
             self.drug_df.to_json(file_name, lines=True,orient='records',compression='infer')
 
 
+def get_integration_parameters(config_data, preformatted_file, data_df):
+    """
+    Read or generate join parameters
+    """
+    if preformatted_file in config_data["integration_recipes"]:
+        return config_data["integration_recipes"][preformatted_file]
+    else:
+        return {'columns': data_df.columns.tolist()}
+
+
 def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='This script integrates COVID-19 related datasets into a single table.')
@@ -297,6 +758,10 @@ def main():
     parser.add_argument('-o', '--output', help='Output file name.', required=True, type=str)
     parser.add_argument('-e', '--entity', help='Type of the entity contained in the tables to be merged.', required=True,
                         choices=['targets', 'drugs'])
+    parser.add_argument('-t', '--taxonomy', help='SQLite file storing the scientific names of the taxonomy identifiers. It is created if missing.', type=str)
+    parser.add_argument('--taxonomyDump', help='NCBI taxonomy names dump (names.dmp) used to populate the taxonomy store.', type=str)
+    parser.add_argument('--fetchTaxonomy', help='Fetch taxonomy identifiers missing from the taxonomy store from ENA. Always enabled if no store is given.', action='store_true')
+    parser.add_argument('-s', '--stateFolder', help='Folder to keep the state of the integration between runs. If provided, only the data of the changed files is updated.', type=str)
 
     args = parser.parse_args()
 
@@ -306,50 +771,111 @@ def main():
     input_folder = args.inputFolder
     output_file = args.output
     entity_type = args.entity
+    state_folder = args.stateFolder
+    taxonomy_store = args.taxonomy
+    taxonomy_dump = args.taxonomyDump
+    fetch_taxonomy = args.fetchTaxonomy or not taxonomy_store
 
     # Reading files from the preformatted folder:
     preformatted_files = [f for f in listdir(input_folder) if isfile(join(input_folder, f))]
     preformatted_files.sort()   
     print('[Info] Integrating the following files:\n\t{}'.format('\n\t'.join(preformatted_files)))
 
-    # 1. Generate first table.
-    if entity_type == "targets":
-        integrator_obj = TargetDataIntegrator(reference_file)
-    else:
-        integrator_obj = DrugDataIntegrator(reference_file)
-
-    # 2. Reading configuration:
+    # 1. Reading configuration:
     with open(config_file, 'rt') as f:
         config_data = json.load(f)
 
-    # Integrating all parsed datasets:
-    for preformatted_file in preformatted_files:
+    # 2. Checking what has changed since the last run:
+    state = None
+    changes = None
+    if state_folder and entity_type == 'targets':
+        state = IntegrationState(state_folder)
+        fingerprints = {
+            'reference': get_file_hash(reference_file),
+            'config': get_file_hash(config_file),
+            'sources': {f: get_file_hash(join(input_folder, f)) for f in preformatted_files}
+        }
+        changes = state.get_changed_sources(fingerprints)
+    elif state_folder:
+        print('[Warning] Incremental integration is only supported for targets. Integrating all files.')
+
+    # The changed sources are read upfront to see if they can be patched into the previous table:
+    data = {}
+    if changes is not None:
+        changed_sources, removed_sources = changes
+        data = {f: read_preformatted_file(input_folder, f) for f in changed_sources}
+        parameters = {f: get_integration_parameters(config_data, f, data_df) for f, data_df in data.items()}
+
+        # Columns of the changed sources must not clash with the columns kept in the table:
+        changed_columns = {f: get_joined_columns(data_df, parameters[f]) for f, data_df in data.items()}
+        kept_columns = [source_state['columns'] for source, source_state in state.previous['sources'].items()
+                        if source not in changed_sources and source not in removed_sources]
+        clashing_columns = IntegrationState.get_clashing_columns(
+            [state.previous['reference_columns']] + kept_columns + list(changed_columns.values()))
+
+        if not all(IntegrationState.is_patchable(data_df, parameters[f]) and not clashing_columns.intersection(changed_columns[f])
+                   for f, data_df in data.items()):
+            print('[Info] Some of the changed files cannot be patched into the previous table.')
+            changes = None
+
+    # 3. Generate first table.
+    if changes is None:
+        if entity_type == "targets":
+            integrator_obj = TargetDataIntegrator(reference_file)
+        else:
+            integrator_obj = DrugDataIntegrator(reference_file)
+
+        reference_columns = integrator_obj.get_integrated_data().columns.tolist()
+        sources = {}
+        files_to_integrate = preformatted_files
+    else:
+        print('[Info] Updating the previously integrated table with:\n\t{}'.format('\n\t'.join(changed_sources + removed_sources)))
+        integrator_obj = TargetDataIntegrator.from_integrated_table(state.load_snapshot(), state.previous['json_columns'])
 
-        # try open file:
-        try:
-            data_df = pd.read_csv('{}/{}'.format(input_folder, preformatted_file), sep='\t')
-        except:
-            print('[Error] Could not open {} as tsv.'.format(preformatted_file))
-            raise
+        # Removing data of the changed and removed sources:
+        reference_columns = state.previous['reference_columns']
+        sources = {}
+        for source, source_state in state.previous['sources'].items():
+            if source in changed_sources or source in removed_sources:
+                integrator_obj.remove_columns(source_state['columns'])
+            else:
+                sources[source] = {'columns': source_state['columns'], 'patchable': source_state['patchable']}
 
-        # Testing if table has id:
-        if 'id' not in data_df.columns.tolist():
-            raise ValueError('The table must have \'id\' column to join.')
+        files_to_integrate = changed_sources
 
-        # Skipping data if the id column is not unique:
-        if len(data_df) != len(data_df['id'].unique()):
-            print('[Warning] The \'id\' column in {} file is not unique!'.format(preformatted_file))
+    # Integrating parsed datasets:
+    for preformatted_file in files_to_integrate:
+        data_df = data[preformatted_file] if preformatted_file in data else read_preformatted_file(input_folder, preformatted_file)
 
         # Read or generate join parameters:
-        parameters = config_data["integration_recipes"][preformatted_file] if preformatted_file in config_data["integration_recipes"] else {'columns':data_df.columns.tolist()}
+        parameters = get_integration_parameters(config_data, preformatted_file, data_df)
+        patchable = IntegrationState.is_patchable(data_df, parameters)
 
         # Integrating:
-        integrator_obj.add_data(data_df, parameters)
+        columns = integrator_obj.add_data(data_df, parameters)
+        sources[preformatted_file] = {'columns': columns, 'patchable': patchable}
+
+    # Sources sharing column names with the reference or other sources cannot be patched:
+    clashing_columns = IntegrationState.get_clashing_columns([reference_columns] + [source['columns'] for source in sources.values()])
+    for source in sources.values():
+        if clashing_columns.intersection(source['columns']):
+            source['patchable'] = False
+
+    # Joining the added data to the table:
+    if entity_type == 'targets':
+        integrator_obj.integrate_data()
+
+    # Saving state for the next run:
+    if state:
+        # Keeping the same column order as a full integration:
+        integrator_obj.order_columns([reference_columns] + [sources[source]['columns'] for source in preformatted_files])
+        state.save(integrator_obj.get_integrated_data(), fingerprints, reference_columns, integrator_obj.json_columns, sources)
 
     # Performing target specific tasks:
     if entity_type == "targets":
         # Map taxonomy to species and apply filters:
-        integrator_obj.map_taxonomy()
+        resolver = TaxonomyResolver(taxonomy_store, taxonomy_dump, remote=fetch_taxonomy)
+        integrator_obj.map_taxonomy(resolver)
     
         # Adding filter columns:
         integrator_obj.add_filter_columns()
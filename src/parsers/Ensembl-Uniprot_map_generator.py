@@ -2,7 +2,7 @@ import pandas as pd
 import argparse
 
 
-if __name__ == '__main__':
+def main():
 
     # Parsing commandline arguments
     parser = argparse.ArgumentParser()
@@ -54,3 +54,5 @@ if __name__ == '__main__':
     merged.to_csv(output_file, sep='\t', index=False)
 
 
+if __name__ == '__main__':
+    main()
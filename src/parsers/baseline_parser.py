@@ -1,8 +1,11 @@
 import json
+import os
+import zipfile
 import pandas as pd
 import argparse
 import logging
-import copy
+import numpy as np
+from id_mapping import get_source_fingerprint
 
 logger = logging.getLogger(__name__)
 
@@ -13,79 +16,128 @@ def get_tissue_mappings(mapping_filename):
         mapping_dict = json.load(mappings_file)
         return mapping_dict['tissues']
 
-def initialise_expression_dict(mapping_dictionary):
+def clean_anatomical_system_name(anatomical_system):
+    # Remove white spaces
+    return anatomical_system.strip().replace(" ", "_")
 
-    # Extract anatomical systems
-    anatomical_systems = set()
-    for tissues, mappings in mapping_dictionary.items():
-        anatomical_systems.update(mappings['anatomical_systems'])
+def get_anatomical_system_incidence(mapping_dictionary, tissues):
+    """
+    Return the list of anatomical systems (in order of appearance in the mapping) and
+    a boolean tissue x anatomical system matrix with the systems of each tissue
+    """
 
-    # Initialise scoring dictionary
-    expression_dict={}
-    for anatomical_system in anatomical_systems:
-        # Remove white spaces
-        anatomical_system_clean_name = anatomical_system.strip().replace(" ", "_")
-        expression_dict[anatomical_system_clean_name] = {
-            'is_expressed' : False,
-            'expressed_tissue_list' : []
-        }
+    # Extract anatomical systems
+    anatomical_systems = []
+    for tissue, mappings in mapping_dictionary.items():
+        for anatomical_system in mappings['anatomical_systems']:
+            anatomical_system_clean_name = clean_anatomical_system_name(anatomical_system)
+            if anatomical_system_clean_name not in anatomical_systems:
+                anatomical_systems.append(anatomical_system_clean_name)
+
+    incidence = np.zeros((len(tissues), len(anatomical_systems)), dtype=bool)
+    for i, tissue in enumerate(tissues):
+        for anatomical_system in mapping_dictionary[tissue]['anatomical_systems']:
+            incidence[i, anatomical_systems.index(clean_anatomical_system_name(anatomical_system))] = True
+
+    return anatomical_systems, incidence
+
+def get_expressed_tissue_lists(expressed, tissues):
+    """
+    Return the expressed tissues of each gene as JSON strings, the lists are built once per unique expression pattern
+    """
+
+    # Rows are encoded as bytes to find the unique patterns:
+    packed_rows = np.packbits(expressed, axis=1)
+    codes, uniques = pd.factorize(pd.Series([row.tobytes() for row in packed_rows], dtype=object))
+    first_rows = np.unique(codes, return_index=True)[1]
+
+    tissue_lists = np.array([json.dumps(tissues[pattern].tolist()) for pattern in expressed[first_rows]], dtype=object)
+
+    return tissue_lists[codes]
+
+def get_expression_per_anatomical_system(expression, tissues, anatomical_systems, incidence, threshold=6):
+    """
+    Return a dataframe with the is_expressed flag and the expressed tissue list of each anatomical system
+    """
+
+    # Gene is considered expressed if > threshold tpm (genes x tissues):
+    expressed = expression > threshold
+
+    # Number of expressed tissues per anatomical system (genes x anatomical systems):
+    expressed_tissue_counts = expressed.astype(np.int32) @ incidence.astype(np.int32)
+
+    columns = {}
+    for i, anatomical_system in enumerate(anatomical_systems):
+        # Drop anatomical systems where no gene is expressed - happens for sensory system
+        if not expressed_tissue_counts[:, i].any():
+            continue
+
+        system_tissues = incidence[:, i]
+        columns[anatomical_system + '_is_expressed'] = expressed_tissue_counts[:, i] > 0
+        columns[anatomical_system + '_expressed_tissue_list'] = get_expressed_tissue_lists(expressed[:, system_tissues], tissues[system_tissues])
+
+    return pd.DataFrame(columns)
+
+def read_baseline(baseline_filename, cache_filename=None):
+    """
+    Return the gene ids, tissue names and the gene x tissue expression matrix (float32) of the baseline file.
+    If a cache file is given, the parsed matrix is stored there and read from it while the baseline file is unchanged.
+    """
+    fingerprint = get_source_fingerprint(baseline_filename)
+
+    if cache_filename and os.path.isfile(cache_filename):
+        try:
+            with np.load(cache_filename) as cache:
+                if str(cache['fingerprint']) == fingerprint:
+                    logger.info("Reading baseline expression from {}".format(cache_filename))
+                    return cache['genes'].astype(object), cache['tissues'].astype(object), cache['expression']
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            logger.warning("Cache file {} is not readable, parsing the baseline file".format(cache_filename))
+
+    # Expression values are read as float32 to halve the memory:
+    header = pd.read_csv(baseline_filename, sep='\t', header=0, nrows=0).columns
+    baseline_df = pd.read_csv(baseline_filename, sep='\t', header=0, index_col=0,
+                              dtype={column: np.float32 for column in header[1:]})
+
+    genes = np.array(baseline_df.index, dtype=object)
+    tissues = np.array(baseline_df.columns, dtype=object)
+    expression = baseline_df.values
+
+    if cache_filename:
+        # Written to an open file, so no .npz suffix is added to the name, and replaced atomically,
+        # so an interrupted run doesn't leave a partial cache:
+        temp_filename = '{}.{}.tmp'.format(cache_filename, os.getpid())
+        with open(temp_filename, 'wb') as f:
+            np.savez(f, fingerprint=fingerprint, genes=genes.astype(str), tissues=tissues.astype(str), expression=expression)
+        os.replace(temp_filename, cache_filename)
+
+    return genes, tissues, expression
+
+def format_output_filename(output_filename, threshold):
+    return output_filename.format(threshold='{:g}'.format(threshold))
+
+def parse_baseline(baseline_filename, tissue_mapping, output_filename, thresholds=(6,), cache_filename=None):
+
+    genes, tissues, expression = read_baseline(baseline_filename, cache_filename)
 
-    return expression_dict
+    # Check that column names in baseline file exist in mapping file
+    is_mapped = np.array([tissue in tissue_mapping for tissue in tissues], dtype=bool)
+    for tissue in tissues[~is_mapped]:
+        logger.warning("{} is not a supported tissue, skipping it".format(tissue))
 
-def parse_baseline(baseline_filename, tissue_mapping, output_filename):
+    # Drop unmapped tissues
+    tissues = tissues[is_mapped]
+    expression = expression[:, is_mapped]
 
+    anatomical_systems, incidence = get_anatomical_system_incidence(tissue_mapping, tissues)
 
-    baseline_df = pd.read_csv(baseline_filename, sep='\t', header=0, index_col=0)
+    # Expression calls for each threshold from the same matrix:
+    for threshold in thresholds:
+        expression_per_anatomical_systems_df = get_expression_per_anatomical_system(expression, tissues, anatomical_systems, incidence, threshold)
+        expression_per_anatomical_systems_df['id'] = genes
 
-    # Check that column names in baseline file exist in mapping file
-    columns_to_drop = []
-    for column in baseline_df.columns:
-        if column not in tissue_mapping:
-            logger.warning("{} is not a supported tissue, skipping it".format(column))
-            columns_to_drop.append(column)
-
-    # Drop unmapped tissues
-    if columns_to_drop:
-        baseline_df.drop(columns_to_drop, axis=1, inplace=True)
-
-    empty_expression_dict = initialise_expression_dict(tissue_mapping)
-    expression_per_anatomical_systems_list = []
-    # Iterate all genes
-    for gene, expression in baseline_df.to_dict('index').items():
-        expression_per_anatomical_systems_dict = copy.deepcopy(empty_expression_dict)
-        expression_per_anatomical_systems_dict['id'] = gene
-        for tissue in expression:
-            # Gene is considered expressed if > 6 tpm
-            if expression[tissue] > 6:
-                for anat_sys in tissue_mapping[tissue]['anatomical_systems']:
-                    # Remove white spaces
-                    anat_sys_clean_name = anat_sys.strip().replace(" ", "_")
-                    expression_per_anatomical_systems_dict[anat_sys_clean_name]['is_expressed'] = True
-                    expression_per_anatomical_systems_dict[anat_sys_clean_name]['expressed_tissue_list'].append(tissue)
-        expression_per_anatomical_systems_list.append(expression_per_anatomical_systems_dict)
-    expression_per_anatomical_systems_df = pd.json_normalize(expression_per_anatomical_systems_list, max_level=1, sep="_")
-
-    # Drop anatomical systems where no gene is expressed - happens for sensory system
-    # Find columns with single unique value - only "is_expressed" columns can be used as lists are not hashable
-    columns_count_unique = expression_per_anatomical_systems_df.filter(regex="is_expressed").nunique()
-    columns_single_unique_value = columns_count_unique[columns_count_unique==1].index
-
-    # Check that the unique values are either False or empty list
-    empty_columns = []
-    for column in columns_single_unique_value:
-        unique_value = expression_per_anatomical_systems_df[column].unique()[0]
-        if unique_value == False:
-            # Add both "is_expressed" column and list column to list to be removed
-            empty_columns.append(column)
-            empty_columns.append(column.replace("is_expressed", "expressed_tissue_list"))
-    expression_per_anatomical_systems_df.drop(columns=empty_columns, inplace=True)
-
-    # Save columns that contain lists as valid JSON strings
-    for column in expression_per_anatomical_systems_df.filter(regex="_list").columns:
-        expression_per_anatomical_systems_df[column] = expression_per_anatomical_systems_df[column].apply(lambda x: json.dumps(x) if isinstance(x, list) else x)
-
-    # Write to file
-    expression_per_anatomical_systems_df.to_csv(output_filename, sep='\t', index=False)
+        # Write to file
+        expression_per_anatomical_systems_df.to_csv(format_output_filename(output_filename, threshold), sep='\t', index=False)
 
 def main():
 
@@ -100,10 +152,20 @@ def main():
                         type=str, default='ot_map_with_efos.json')
 
     parser.add_argument('-o','--output',
-                        help='Output file name',
+                        help='Output file name. With multiple thresholds it has to contain a {threshold} placeholder, eg. baseline_{threshold}tpm.tsv',
                         type=str, default='baseline_expression_per_anatomical_system.tsv')
 
+    parser.add_argument('-t','--thresholds',
+                        help='TPM thresholds above which a gene is considered expressed in a tissue (default: 6)',
+                        type=float, nargs='+', default=[6])
 
+    parser.add_argument('-c','--cache',
+                        help='Binary file caching the parsed expression matrix (default: the input file name with .npz extension added)',
+                        type=str)
+
+    parser.add_argument('--nocache',
+                        help='Read the baseline file without using or updating the cache file',
+                        action='store_true')
 
     args = parser.parse_args()
 
@@ -111,10 +173,15 @@ def main():
     input_file = args.input
     mapping_file = args.mapping
     output_file = args.output
+    thresholds = args.thresholds
+    cache_file = None if args.nocache else args.cache or input_file + '.npz'
+
+    if len(set(format_output_filename(output_file, threshold) for threshold in thresholds)) < len(thresholds):
+        parser.error('the output file name has to contain a {threshold} placeholder when multiple thresholds are given')
 
     # Load tissue mappings
     tissue_mappings = get_tissue_mappings(mapping_file)
-    parse_baseline(input_file, tissue_mappings, output_file)
+    parse_baseline(input_file, tissue_mappings, output_file, thresholds, cache_file)
 
 if __name__ == '__main__':
     main()
@@ -27,7 +27,7 @@ def parse_complex_file(input_file):
     return exploded_df
 
 
-if __name__ == '__main__':
+def main():
 
     # Parsing commandline arguments
     parser = argparse.ArgumentParser()
@@ -47,3 +47,5 @@ if __name__ == '__main__':
     complex_table.to_csv(output_file, sep='\t', index=False)
 
 
+if __name__ == '__main__':
+    main()
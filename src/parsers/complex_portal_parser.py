@@ -1,25 +1,27 @@
 import argparse
 import pandas as pd
-import requests
+from ensembl_lookup import EnsemblXrefLookup
+from id_mapping import IdMapper, get_default_index_dir
 pd.options.mode.chained_assignment = None # Supressing chain copy warnings
 
+UNIPROT_ACCESSION_PATTERN = r'^(?:[OPQ][0-9][A-Z0-9]{3}[0-9]|[A-NR-Z][0-9](?:[A-Z][A-Z0-9]{2}[0-9]){1,2})$'
+
 
 # Function to map uniprot accessions to ensembl gene IDs.
-def map_primary_uniprot_accession_to_ensembl(accession, organism = 'homo_sapiens'):
+def map_primary_uniprot_accession_to_ensembl(accessions, lookup, remote=True):
+    """
+    Returns a series with the Ensembl gene IDs of the accessions (NaN if not mapped).
 
-    URL = 'http://rest.ensembl.org/xrefs/symbol/{}/{}?content-type=application/json&object_type=gene'.format(
-        organism,accession)
+    The accessions are joined with the local mapping first, only the UniProt accessions
+    missing from it are looked up remotely.
+    """
+    ensembl_ids = lookup.id_mapper.map_uniprot(accessions, first=True)
 
-    response = requests.get(URL).json()
+    missing = accessions.loc[ensembl_ids.isnull() & accessions.str.match(UNIPROT_ACCESSION_PATTERN)]
+    if remote and len(missing) > 0:
+        ensembl_ids.loc[missing.index] = lookup.map_accessions(['homo_sapiens'] * len(missing), missing)
 
-    if 'error' in response:
-        print('[Warning] Could not find Ensembl gene ID to {}'.format(accession))
-        return None
-    
-    try:
-        return response[0]['id'] if len(response) > 0 else None
-    except:
-        return None
+    return ensembl_ids
 
 
 def main():
@@ -29,6 +31,12 @@ def main():
 
     parser.add_argument('-i', '--input', help='Complexportal COVID-19 tsv file.', required=True, type=str)
     parser.add_argument('-o', '--output', help='Output tsv file of the parsed complexportal file.', required=True, type=str)
+    parser.add_argument('-m', '--mapping', help='Uniprot to Ensembl mapping file.', required=True, type=str)
+    parser.add_argument('--indexdir', help='Folder of the id mapping indexes. Default: id_mapping_index folder next to the mapping file.', type=str)
+    parser.add_argument('-c', '--cache', help='SQLite file caching the Ensembl lookups of the accessions missing from the mapping file.', type=str)
+    parser.add_argument('--server', help='Ensembl REST server. Default: https://rest.ensembl.org', default='https://rest.ensembl.org', type=str)
+    parser.add_argument('--noremote', help='Do not look up the accessions missing from the mapping file in Ensembl.', action='store_true')
+    parser.add_argument('--allowFailedLookups', help='Keep the UniProt accession as id if the Ensembl lookup fails, instead of stopping.', action='store_true')
 
     args = parser.parse_args()
     input_complex_file = args.input
@@ -40,21 +48,27 @@ def main():
     complex_df.drop(complex_df.loc[complex_df.component_id.str.match('CPX')].index, inplace=True)
 
     # Update component ID:
-    complex_df['component_id'] = complex_df.component_id.apply(lambda x: x.split('-')[0])
+    complex_df['component_id'] = complex_df.component_id.str.split('-').str[0]
 
     # Pool components:
-    complexes = []
-    for component_id, group in complex_df.groupby(['component_id']):
-        complex_names = group.complex_name.unique().tolist()
-        
-        # Looking up ensembl gene id:
-        ensembl_id = map_primary_uniprot_accession_to_ensembl(component_id) if map_primary_uniprot_accession_to_ensembl(component_id) else component_id
-        complexes.append({
-            'id': ensembl_id,
-            'COVID_complex_names': complex_names
-        })
-        
-    covid_complexes = pd.DataFrame(complexes)
+    complex_names = (
+        complex_df
+        .drop_duplicates(['component_id', 'complex_name'])
+        .groupby('component_id')
+        .complex_name.agg(list)
+    )
+
+    # Looking up ensembl gene id:
+    id_mapper = IdMapper(args.indexdir or get_default_index_dir(args.mapping), uniprot_map_file=args.mapping)
+    lookup = EnsemblXrefLookup(cache_file=args.cache, id_mapper=id_mapper, server=args.server,
+                               allow_failures=args.allowFailedLookups)
+    component_ids = pd.Series(complex_names.index)
+    ensembl_ids = map_primary_uniprot_accession_to_ensembl(component_ids, lookup, remote=not args.noremote)
+
+    covid_complexes = pd.DataFrame({
+        'id': ensembl_ids.fillna(component_ids),
+        'COVID_complex_names': complex_names.values
+    })
     covid_complexes.to_csv(output_parsed_file, sep='\t', index=False)
 
 if __name__ == '__main__':
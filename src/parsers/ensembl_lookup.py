@@ -0,0 +1,153 @@
+import sqlite3
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Lookup of Ensembl gene IDs for UniProt accessions through the Ensembl REST API.
+"""
+
+
+class EnsemblXrefLookup(object):
+    """
+    Maps UniProt accessions to Ensembl gene IDs.
+
+    Human accessions found in the local UniProt to Ensembl map (an IdMapper) are resolved without any request.
+    The results of the REST lookups are cached in a SQLite file keyed by (organism, accession),
+    cached values older than the TTL are looked up again. The requests are sent by a thread pool,
+    limited to a maximum rate and retried on failures. If some lookups still fail, a RuntimeError
+    is raised unless allow_failures is set, in which case the failed accessions are left unmapped.
+    """
+
+    def __init__(self, cache_file=None, id_mapper=None, ttl_days=30, workers=4, max_rate=15, retries=3,
+                 server='https://rest.ensembl.org', allow_failures=False):
+        self.server = server.rstrip('/')
+        self.allow_failures = allow_failures
+        self.ttl = ttl_days * 24 * 3600
+        self.workers = workers
+        self.retries = retries
+        self.interval = 1.0 / max_rate
+        self.next_request = 0
+        self.rate_lock = threading.Lock()
+
+        self.id_mapper = id_mapper
+
+        # Opening cache:
+        self.cache = None
+        if cache_file:
+            self.cache = sqlite3.connect(cache_file, check_same_thread=False)
+            self.cache.execute(
+                'CREATE TABLE IF NOT EXISTS xref (organism TEXT, accession TEXT, ensembl_id TEXT, updated REAL, '
+                'PRIMARY KEY (organism, accession))'
+            )
+
+    def wait_for_slot(self):
+        """
+        Blocks until the next request is allowed by the rate limit.
+        """
+        with self.rate_lock:
+            now = time.time()
+            wait = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.interval
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def fetch(self, organism, accession):
+        """
+        Returns the first Ensembl gene ID of the accession, None if there is no such gene.
+        Raises an exception if the lookup fails after all retries.
+        """
+        url = '{}/xrefs/symbol/{}/{}'.format(self.server, organism, accession)
+
+        for attempt in range(self.retries + 1):
+            self.wait_for_slot()
+            try:
+                response = requests.get(url, params={'object_type': 'gene'},
+                                        headers={'Content-Type': 'application/json'}, timeout=30)
+
+                # Too many requests or server side errors are retried:
+                if response.status_code == 429 or response.status_code >= 500:
+                    raise requests.HTTPError('HTTP {}'.format(response.status_code), response=response)
+
+                data = response.json()
+                if 'error' in data:
+                    print('[Warning] Could not find Ensembl gene ID to {}'.format(accession))
+                    return None
+
+                return data[0]['id'] if len(data) > 0 else None
+
+            except (requests.RequestException, ValueError) as e:
+                if attempt == self.retries:
+                    raise
+
+                # Waiting as requested by the server or backing off exponentially:
+                retry_after = getattr(getattr(e, 'response', None), 'headers', {}).get('Retry-After')
+                time.sleep(float(retry_after) if retry_after else 2 ** attempt)
+
+    def read_cache(self, keys):
+        cached = {}
+        if self.cache is None:
+            return cached
+
+        oldest = time.time() - self.ttl
+        for organism, accession in keys:
+            row = self.cache.execute('SELECT ensembl_id, updated FROM xref WHERE organism = ? AND accession = ?',
+                                     (organism, accession)).fetchone()
+            if row and row[1] >= oldest:
+                cached[(organism, accession)] = row[0]
+
+        return cached
+
+    def write_cache(self, results):
+        if self.cache is None or len(results) == 0:
+            return
+
+        now = time.time()
+        with self.cache:
+            self.cache.executemany('INSERT OR REPLACE INTO xref VALUES (?, ?, ?, ?)',
+                                   [(organism, accession, ensembl_id, now) for (organism, accession), ensembl_id in results.items()])
+
+    def map_accessions(self, organisms, accessions):
+        """
+        Returns the list of Ensembl gene IDs (or None) for the given organisms (eg. homo_sapiens) and accessions.
+        Raises a RuntimeError if a lookup failed after all retries, unless failures are allowed.
+        """
+        keys = list(zip(organisms, accessions))
+        unique_keys = list(dict.fromkeys(keys))
+
+        # Local map first, then the cache:
+        mapped = {}
+        if self.id_mapper:
+            human_keys = [key for key in unique_keys if key[0] == 'homo_sapiens']
+            ensembl_ids = self.id_mapper.map_uniprot([key[1] for key in human_keys], first=True)
+            mapped = {key: ensembl_id for key, ensembl_id in zip(human_keys, ensembl_ids) if ensembl_id == ensembl_id}
+
+        mapped.update(self.read_cache([key for key in unique_keys if key not in mapped]))
+
+        # Fetching the rest:
+        missing = [key for key in unique_keys if key not in mapped]
+        if missing:
+            print('[Info] Looking up {} accessions in Ensembl...'.format(len(missing)))
+
+            def lookup(key):
+                try:
+                    return key, self.fetch(*key), True
+                except Exception as e:
+                    print('[Warning] Failed to look up {}: {}'.format(key[1], e))
+                    return key, None, False
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(lookup, missing))
+
+            # Only the successful lookups are cached, so the failed ones are retried in the next run:
+            fetched = {key: ensembl_id for key, ensembl_id, success in results if success}
+            self.write_cache(fetched)
+            mapped.update(fetched)
+
+            failed = [key[1] for key, _, success in results if not success]
+            if failed and not self.allow_failures:
+                raise RuntimeError('Failed to look up {} accessions in Ensembl: {}'.format(len(failed), ', '.join(failed)))
+
+        return [mapped.get(key) for key in keys]
@@ -1,7 +1,13 @@
 import json
 import gzip
+import os
+import re
 import argparse
 import pandas as pd
+from multiprocessing import Pool
+
+# Gene identifiers in a raw json line (nested objects have their own ids, but those are not ENSG ids):
+GENE_ID_PATTERN = re.compile(rb'"id"\s*:\s*"(ENSG[^"]*)"')
 
 def parsing_ensembl_json(data):
     """
@@ -35,7 +41,8 @@ def get_uniprot_ids(data):
     if 'Uniprot/SWISSPROT' in data:
         ids += data['Uniprot/SWISSPROT']
         
-    ids = list(set(ids))
+    # Dropping duplicates keeping the order, so the output doesn't depend on the hash seed of the workers:
+    ids = list(dict.fromkeys(ids))
     
     return ids
 
@@ -66,6 +73,89 @@ def get_target_list(targetList_file):
     return df.ensembl_id
 
 
+def get_line_aligned_chunks(filename, chunk_count):
+    """
+    Splitting a newline delimited file into byte ranges aligned to line boundaries.
+
+    Output: list of (start, end) tuples
+    """
+
+    file_size = os.path.getsize(filename)
+    offsets = [0]
+
+    with open(filename, 'rb') as f:
+        for i in range(1, chunk_count):
+            offset = file_size * i // chunk_count
+
+            # Moving the offset to the beginning of the next line:
+            f.seek(max(offset - 1, 0))
+            f.readline()
+            offsets.append(max(f.tell(), offsets[-1]))
+
+    offsets.append(file_size)
+
+    # Empty chunks are dropped (at least one chunk is returned):
+    chunks = [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if start < end]
+    return chunks if chunks else [(0, file_size)]
+
+
+def parse_ensembl_chunk(input_file, target_set, start=0, end=None, keep_table=False):
+    """
+    Parsing the target genes of the Ensembl json file between the start and end byte offsets.
+    The offsets have to be aligned to line boundaries.
+
+    Output: tuple
+    json_data: gzip compressed json lines of the parsed genes (a gzip member, members can be concatenated)
+    uniprot_pairs: list of (uniprot id, ensembl id) tuples in order of appearance
+    genes_df: table of the parsed genes (PDB ids are comma separated), None if keep_table is not set or no gene is parsed
+    """
+    target_id_set = set(x.encode() for x in target_set)
+    json_lines = []
+    uniprot_pairs = []
+    parsed_genes = []
+
+    with open(input_file, 'rb') as f:
+        f.seek(start)
+        position = start
+
+        for line in f:
+
+            # Stop at the end of the chunk:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+
+            # Skipping lines without any target id before decoding the json:
+            if not any(gene_id in target_id_set for gene_id in GENE_ID_PATTERN.findall(line)):
+                continue
+
+            # Read data:
+            data = json.loads(line)
+
+            # Skipp gene if not found in the OT target list:
+            if data['id'] not in target_set:
+                continue
+
+            # Parse fields:
+            parsed_data = parsing_ensembl_json(data)
+            json_lines.append(json.dumps(parsed_data) + '\n')
+            if keep_table:
+                parsed_genes.append(parsed_data)
+
+            # Add UniProt mappings for current gene
+            uniprot_pairs += [(protein, parsed_data['ensembl_id']) for protein in parsed_data['uniprot_ids']]
+
+    json_data = gzip.compress(''.join(json_lines).encode())
+
+    # PDB ids are joined into a string, as loading millions of short strings is slow:
+    genes_df = None
+    if parsed_genes:
+        genes_df = pd.DataFrame(parsed_genes)
+        genes_df['PDB'] = genes_df['PDB'].str.join(',')
+
+    return json_data, uniprot_pairs, genes_df
+
+
 def main():
     
     # Parse command line arguments
@@ -75,6 +165,9 @@ def main():
     parser.add_argument('-o', '--output', help='Output file name.', required=True, type=str)
     parser.add_argument('-m', '--mappingFile', help='Name of output UniProt to Ensembl id mapping file', type=str, default='uniprot2ensembl.tsv')
     parser.add_argument('-t', '--targetListFile', help='Name of the OpenTargets target list file', type=str)
+    parser.add_argument('-p', '--pickleOutput', help='Name of the output file with the parsed genes as a pickled table (loads faster than the json file, PDB ids are comma separated).', type=str)
+    parser.add_argument('-f', '--featherOutput', help='Name of the output file with the parsed genes as a Feather table (requires pyarrow, columns can be read separately).', type=str)
+    parser.add_argument('-w', '--workers', help='Number of processes parsing the input file.', type=int, default=1)
 
     args = parser.parse_args()
 
@@ -83,44 +176,52 @@ def main():
     output_file = args.output
     mapping_file = args.mappingFile
     targetList_file = args.targetListFile
+    pickle_file = args.pickleOutput
+    feather_file = args.featherOutput
+    workers = args.workers
+    keep_table = bool(pickle_file or feather_file)
 
     # Get OT target list:
     target_list = get_target_list(targetList_file)
-
-    # Open output gzip file.
-    output_file_handle = gzip.open(output_file, 'wt')
-
-    # Dictionary to store UniProt id to Ensembl mapping
+    target_set = set(target_list)
+
+    # Parsing the input file, in chunks of lines if there are multiple workers:
+    if workers > 1:
+        # Using more chunks than workers to balance the load:
+        chunks = get_line_aligned_chunks(input_file, workers * 4)
+        with Pool(workers) as pool:
+            parsed_chunks = pool.starmap(parse_ensembl_chunk,
+                                         [(input_file, target_set, start, end, keep_table) for start, end in chunks])
+    else:
+        parsed_chunks = [parse_ensembl_chunk(input_file, target_set, keep_table=keep_table)]
+
+    # Saving the gzip members of the chunks in order of the input file:
+    with open(output_file, 'wb') as f:
+        for json_data, _, _ in parsed_chunks:
+            f.write(json_data)
+
+    # Save parsed genes as tables:
+    if keep_table:
+        genes_dfs = [genes_df for _, _, genes_df in parsed_chunks if genes_df is not None]
+
+        # If no target gene is found, an empty table is saved with the parsed fields as columns:
+        if genes_dfs:
+            parsed_genes_df = pd.concat(genes_dfs, ignore_index=True)
+        else:
+            parsed_genes_df = pd.DataFrame(columns=list(parsing_ensembl_json({})))
+        if pickle_file:
+            parsed_genes_df.to_pickle(pickle_file)
+        if feather_file:
+            parsed_genes_df.to_feather(feather_file)
+
+    # Merging the UniProt to Ensembl mappings of the chunks in order of the input file:
     uniprot2ensembl_map = {}
-
-    # Open and looping through all ensembl genes:
-    with open(input_file, 'r') as i:
-        for line in i:        
-            # Read data:
-            try:
-                data = json.loads(line.strip())
-
-                # Skipp gene if not found in the OT target list:
-                if data['id'] not in target_list.unique():
-                    continue
-                
-                # Parse fields:
-                parsed_data = parsing_ensembl_json(data)
-                
-                # Save parsed field:
-                output_file_handle.write(json.dumps(parsed_data)+'\n')
-
-                # Add UniProt mappings for current gene
-                for protein in parsed_data['uniprot_ids']:
-                    if protein in uniprot2ensembl_map:
-                        uniprot2ensembl_map[protein].append(parsed_data['ensembl_id'])
-                    else:
-                        uniprot2ensembl_map[protein] = [parsed_data['ensembl_id']]
-                
-            except:
-                raise
-                
-    output_file_handle.close()
+    for _, uniprot_pairs, _ in parsed_chunks:
+        for protein, ensembl_id in uniprot_pairs:
+            if protein in uniprot2ensembl_map:
+                uniprot2ensembl_map[protein].append(ensembl_id)
+            else:
+                uniprot2ensembl_map[protein] = [ensembl_id]
 
     # Save UniProt to Ensembl  mapping as a tsv
     uniprot2ensembl_df = pd.DataFrame.from_dict({'uniprot_id': list(uniprot2ensembl_map.keys()), 'ensembl_id': list(uniprot2ensembl_map.values())}, orient='columns').explode('ensembl_id')
@@ -0,0 +1,219 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+"""
+Shared lookup of Ensembl gene IDs by UniProt accession or gene symbol.
+"""
+
+# Source of each index, the indexes of the same source are built together:
+INDEX_SOURCES = {'uniprot': 'uniprot', 'symbol': 'ensembl', 'genes': 'ensembl'}
+
+
+def get_source_fingerprint(filename, sample_size=0):
+    """
+    Returns a cheap fingerprint of the file: size and modification time (in nanoseconds).
+    If sample_size is set, the hash of the first and last sample_size bytes of the file is added.
+    """
+    file_stat = os.stat(filename)
+    fingerprint = '{}-{}'.format(file_stat.st_size, file_stat.st_mtime_ns)
+    if not sample_size:
+        return fingerprint
+
+    file_hash = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        file_hash.update(f.read(sample_size))
+        if file_stat.st_size > sample_size:
+            f.seek(max(file_stat.st_size - sample_size, sample_size))
+            file_hash.update(f.read())
+
+    return '{}:{}'.format(fingerprint, file_hash.hexdigest())
+
+
+def get_default_index_dir(source_file):
+    """
+    Returns the index folder next to the source file.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(source_file)), 'id_mapping_index')
+
+
+def read_ensembl_genes(ensembl_file):
+    """
+    Returns a dataframe with the id and name of the parsed Ensembl genes (json.gz, pickled or Feather table).
+    """
+    if ensembl_file.endswith('.pkl'):
+        return pd.read_pickle(ensembl_file)[['id', 'name']]
+    if ensembl_file.endswith('.feather'):
+        return pd.read_feather(ensembl_file, columns=['id', 'name'])
+
+    ids = []
+    names = []
+    with gzip.open(ensembl_file, 'rt') as f:
+        for line in f:
+            gene = json.loads(line)
+            ids.append(gene['id'])
+            names.append(gene['name'])
+
+    return pd.DataFrame({'id': ids, 'name': names})
+
+
+class IdMapper(object):
+    """
+    Maps UniProt accessions and gene symbols to Ensembl gene IDs.
+
+    The lookup indexes are built once from the parsed Ensembl genes and from the UniProt to Ensembl
+    map, then stored in the index folder as .npy files, which are loaded memory mapped. Each index
+    is a sorted array of keys with the corresponding genes, looked up in batch with searchsorted.
+    A key mapped to multiple genes has consecutive rows, in the order of the source file.
+    An index is rebuilt when its source file changes, together with the other indexes of the same source.
+    """
+
+    def __init__(self, index_dir, ensembl_file=None, uniprot_map_file=None):
+        self.index_dir = index_dir
+        self.ensembl_file = ensembl_file
+        self.uniprot_map_file = uniprot_map_file
+        self.indexes = {}
+
+    def get_source_file(self, index_name):
+        return self.uniprot_map_file if INDEX_SOURCES[index_name] == 'uniprot' else self.ensembl_file
+
+    def build_indexes(self, source):
+        """
+        Returns the keys and genes of all indexes of the source, which is read once.
+        """
+        if source == 'uniprot':
+            map_df = pd.read_csv(self.uniprot_map_file, sep='\t', usecols=['uniprot_id', 'ensembl_id']).dropna()
+            return {'uniprot': (map_df.uniprot_id.values, map_df.ensembl_id.values)}
+
+        genes_df = read_ensembl_genes(self.ensembl_file)
+        named_df = genes_df.dropna()
+        return {
+            'genes': (genes_df.id.values, genes_df.id.values),
+            'symbol': (named_df.name.values, named_df.id.values)
+        }
+
+    def save_index(self, index_name, keys, genes, fingerprint):
+        """
+        Writes the index files, keys are sorted, except for the list of genes, which is kept in file order.
+        """
+        keys = np.asarray(keys, dtype=str)
+        genes = np.asarray(genes, dtype=str)
+        if index_name != 'genes':
+            order = np.argsort(keys, kind='stable')
+            keys = keys[order]
+            genes = genes[order]
+        arrays = {'keys': keys, 'genes': genes}
+
+        # Files are replaced atomically, so parsers running in parallel don't read partial indexes:
+        os.makedirs(self.index_dir, exist_ok=True)
+        for part, filename in self.get_index_files(index_name).items():
+            temp_file = '{}.{}.tmp.npy'.format(filename[:-4], os.getpid())
+            np.save(temp_file, arrays[part])
+            os.replace(temp_file, filename)
+
+        meta_file = self.get_meta_file(index_name)
+        temp_file = '{}.{}.tmp'.format(meta_file, os.getpid())
+        with open(temp_file, 'wt') as f:
+            json.dump({'source': os.path.abspath(self.get_source_file(index_name)), 'fingerprint': fingerprint}, f)
+        os.replace(temp_file, meta_file)
+
+    def get_index_files(self, index_name):
+        return {part: os.path.join(self.index_dir, '{}_{}.npy'.format(index_name, part)) for part in ['keys', 'genes']}
+
+    def get_meta_file(self, index_name):
+        return os.path.join(self.index_dir, '{}.json'.format(index_name))
+
+    def get_index(self, index_name):
+        if index_name in self.indexes:
+            return self.indexes[index_name]
+
+        source_file = self.get_source_file(index_name)
+        if source_file is None:
+            raise ValueError('No source file is given for the {} index.'.format(index_name))
+
+        fingerprint = get_source_fingerprint(source_file)
+
+        # Checking if the stored index was built from the same source:
+        try:
+            with open(self.get_meta_file(index_name), 'rt') as f:
+                is_current = json.load(f)['fingerprint'] == fingerprint
+        except (OSError, ValueError, KeyError):
+            is_current = False
+
+        # All indexes of the source are rebuilt together, so the source is only read once:
+        if not is_current:
+            print('[Info] Building {} id mapping index from {}'.format(INDEX_SOURCES[index_name], source_file))
+            for name, (keys, genes) in self.build_indexes(INDEX_SOURCES[index_name]).items():
+                self.save_index(name, keys, genes, fingerprint)
+
+        files = self.get_index_files(index_name)
+        self.indexes[index_name] = tuple(np.load(files[part], mmap_mode='r') for part in ['keys', 'genes'])
+        return self.indexes[index_name]
+
+    def lookup(self, index_name, ids, key_column, first=False):
+        """
+        Returns a dataframe with all the genes of the ids, in order of the ids.
+        If first is set, a series aligned with the ids is returned with the first gene of each id (NaN if not mapped).
+        """
+        keys, genes = self.get_index(index_name)
+        queries = np.asarray(ids, dtype=str)
+
+        start = np.searchsorted(keys, queries, side='left')
+        end = np.searchsorted(keys, queries, side='right')
+        counts = end - start
+
+        if first:
+            first_genes = np.full(len(queries), np.nan, dtype=object)
+            first_genes[counts > 0] = np.asarray(genes[start[counts > 0]])
+            return pd.Series(first_genes, index=ids.index if isinstance(ids, pd.Series) else None)
+
+        # Expanding matches, one row for each gene:
+        query_index = np.repeat(np.arange(len(queries)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        positions = np.repeat(start, counts) + offsets
+
+        return pd.DataFrame({
+            key_column: queries[query_index].astype(object),
+            'ensembl_id': np.asarray(genes[positions]).astype(object)
+        })
+
+    def map_uniprot(self, ids, first=False):
+        """
+        Returns a dataframe with the uniprot_id and ensembl_id of the mapped accessions.
+        """
+        return self.lookup('uniprot', ids, 'uniprot_id', first)
+
+    def map_symbol(self, names, first=False):
+        """
+        Returns a dataframe with the name and ensembl_id of the mapped gene symbols.
+        """
+        return self.lookup('symbol', names, 'name', first)
+
+    def get_genes(self):
+        """
+        Returns the list of all Ensembl gene IDs in order of the Ensembl file.
+        """
+        keys, genes = self.get_index('genes')
+        return genes.tolist()
+
+
+if __name__ == '__main__':
+
+    # Parsing commandline arguments
+    parser = argparse.ArgumentParser(description='Builds the id mapping indexes used by the parsers.')
+
+    parser.add_argument('-i', '--indexdir', help='Folder of the index files.', required=True, type=str)
+    parser.add_argument('-e', '--ensembl', help='Parsed Ensembl genes (json.gz, pickled or Feather table).', type=str)
+    parser.add_argument('-u', '--uniprotmap', help='Uniprot to Ensembl mapping file.', type=str)
+    args = parser.parse_args()
+
+    mapper = IdMapper(args.indexdir, ensembl_file=args.ensembl, uniprot_map_file=args.uniprotmap)
+    if args.ensembl:
+        mapper.get_index('genes')
+        mapper.get_index('symbol')
+    if args.uniprotmap:
+        mapper.get_index('uniprot')
@@ -1,22 +1,18 @@
 import pandas as pd
 import argparse
-import re
 import json
 import numpy as np
+import os
+from array import array
+from multiprocessing import Pool
+from id_mapping import IdMapper, get_default_index_dir, get_source_fingerprint
 
-
-def parse_organism(x):
-    """
-    The taxonomy ID is returned based on the provided 'Taxid interactor' value eg. taxid:10090(mouse)|taxid:10090(Mus musculus)
-    """
-    
-    if x =='-':
-        return None
-    
-    x = x.split('|')[1] if len(x.split('|')) > 1 else x
-
-    organism_id = re.search('taxid:(-*\d+)', x).group(1)
-    return organism_id
+# Use the faster json decoder if available:
+try:
+    import orjson
+    loads_json = orjson.loads
+except ImportError:
+    loads_json = json.loads
 
 
 def parse_network(filename):
@@ -41,8 +37,8 @@ def get_direct_interactors(input_df):
     taxonomy_ids = ['2697049','694009','9606']
     
     # Filter out homologs:
-    filtered_interact = network_df.loc[network_df['taxid_b'].isin(taxonomy_ids) &
-                  network_df['taxid_a'].isin(taxonomy_ids)]
+    filtered_interact = input_df.loc[input_df['taxid_b'].isin(taxonomy_ids) &
+                  input_df['taxid_a'].isin(taxonomy_ids)]
 
     # Filter out human/human interactions:
     filtered_interact = filtered_interact.loc[~((filtered_interact['taxid_b']=='9606') &
@@ -51,63 +47,141 @@ def get_direct_interactors(input_df):
 
     # Select a few columns:
     filtered_interact = filtered_interact.drop_duplicates()
-    
-    # Get unique list of interactors:
-    interactors = filtered_interact.id_a.append( filtered_interact.id_b).unique()
-
-    # aggregating interactors across IDs:
-    aggregated_interactions = []
-    for interactor in interactors:
-        interaction_ids = filtered_interact.loc[(filtered_interact.id_a == interactor ) |
-                      (filtered_interact.id_b == interactor),'interaction_id'].unique().tolist()
-        
-        # Get taxonomy id of the interactor:
-        try:
-            tax_id = filtered_interact.loc[ filtered_interact.id_a == interactor ].taxid_a.tolist()[0]
-        except:
-            tax_id = filtered_interact.loc[ filtered_interact.id_b == interactor ].taxid_b.tolist()[0]
-        
-        aggregated_interactions.append({
-            'uniprot_id': interactor.split('-')[0],
-            'Covid_direct_interactions': interaction_ids,
-            'tax_id': tax_id
-        })
-    
+
+    # Stacking both sides of the interactions into a single long table:
+    # (interactor A rows come first, so the first taxonomy found for a protein is the one on the A side)
+    interactor_df = pd.concat([
+        filtered_interact[['id_a', 'taxid_a', 'interaction_id']].rename(columns={'id_a': 'uniprot_id', 'taxid_a': 'tax_id'}),
+        filtered_interact[['id_b', 'taxid_b', 'interaction_id']].rename(columns={'id_b': 'uniprot_id', 'taxid_b': 'tax_id'})
+    ])
+
+    # Keeping track of the original row order to preserve the order of the interaction ids:
+    interactor_df['row'] = np.tile(np.arange(len(filtered_interact)), 2)
+
+    # Get taxonomy id of the interactors (index order follows the order of appearance):
+    tax_ids = interactor_df.groupby('uniprot_id', sort=False).tax_id.first()
+
+    # Aggregating unique interaction ids across interactors:
+    interaction_ids = (
+        interactor_df
+        .sort_values('row', kind='stable')
+        .drop_duplicates(['uniprot_id', 'interaction_id'])
+        .groupby('uniprot_id', sort=False)
+        .interaction_id.agg(list)
+        .reindex(tax_ids.index)
+    )
+
     # Return dataframe:
-    return pd.DataFrame(aggregated_interactions)
-    
+    return pd.DataFrame({
+        'uniprot_id': tax_ids.index.str.split('-').str[0],
+        'Covid_direct_interactions': interaction_ids.tolist(),
+        'tax_id': tax_ids.tolist()
+    })
+
 
-def get_second_level_interactions(indirect_interactions_list, human_interactions_df):
+class InteractionNetwork(object):
     """
+    Adjacency index of the human interaction network.
 
+    Uniprot ids are integer encoded and every interaction is stored in both directions
+    in CSR arrays, so the neighbours of any set of proteins are looked up without
+    scanning the full interaction table.
     """
 
-    # Filter interactions between direct interactors and other proteins (~42k):
-    second_level_interactions = human_interactions_df.loc[
-                                    (human_interactions_df.interactor_a.isin(indirect_interactions_list)) |
-                                    (human_interactions_df.interactor_b.isin(indirect_interactions_list))
-                                ]
-    # 
-    secondary_interactions = {}
-    for index, row in second_level_interactions.iterrows():
-
-        if row['interactor_a'] in indirect_interactions_list:
-            # Adding interactor B:
-            try:
-                secondary_interactions[row['interactor_b']].append(row['interaction_identifier'])
-            except: 
-                secondary_interactions[row['interactor_b']] = [row['interaction_identifier']] 
-
-        if row['interactor_b'] in indirect_interactions_list:
-            # Adding interactor A:
-            try:
-                secondary_interactions[row['interactor_a']].append(row['interaction_identifier'])
-            except: 
-                secondary_interactions[row['interactor_a']] = [row['interaction_identifier']] 
-
-    # Return dataframe with indirect interactions:        
-    return pd.DataFrame({'uniprot_id': list(secondary_interactions.keys()), 
-                       'Covid_indirect_interactions': list(secondary_interactions.values())})
+    def __init__(self, human_interactions_df):
+
+        edge_count = len(human_interactions_df)
+
+        # Integer encoding of the interactors (interactor a codes followed by interactor b codes):
+        codes, self.proteins = pd.factorize(pd.concat([human_interactions_df.interactor_a.astype(str),
+                                                       human_interactions_df.interactor_b.astype(str)],
+                                                      ignore_index=True))
+
+        # Each interaction is stored as a->b (direction 0) and b->a (direction 1):
+        source = codes
+        target = np.concatenate([codes[edge_count:], codes[:edge_count]])
+        row = np.tile(np.arange(edge_count), 2)
+        direction = np.repeat([0, 1], edge_count)
+
+        # Sorting edges by source protein, keeping the original row order within each protein:
+        order = np.lexsort((direction, row, source))
+        self.targets = target[order]
+        self.rows = row[order]
+        self.directions = direction[order]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(source, minlength=len(self.proteins)))])
+
+        self.interaction_ids = human_interactions_df.interaction_identifier.to_numpy()
+
+    def get_edges(self, protein_codes):
+        """
+        Returns the positions of all edges starting from the given proteins.
+        """
+        starts = self.indptr[protein_codes]
+        lengths = self.indptr[protein_codes + 1] - starts
+
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return offsets + np.arange(lengths.sum())
+
+    def get_neighbours(self, uniprot_ids, hops=1):
+        """
+        Collects the interactions of the proteins reachable from the provided proteins
+        within the given number of hops. At every hop only the newly reached proteins are expanded.
+
+        Output: pd.DataFrame
+        uniprot_id: uniprot identifier of the neighbour
+        interaction_identifier: intact identifier of the interaction connecting it to the previous hop
+        """
+
+        # Proteins not found in the network have no neighbours:
+        frontier = self.proteins.get_indexer(pd.unique(pd.Series(uniprot_ids, dtype=str)))
+        frontier = frontier[frontier >= 0]
+
+        visited = np.zeros(len(self.proteins), dtype=bool)
+        visited[frontier] = True
+
+        edges = []
+        for hop in range(hops):
+            hop_edges = self.get_edges(frontier)
+
+            # Keeping the row order of the interaction table:
+            hop_edges = hop_edges[np.lexsort((self.directions[hop_edges], self.rows[hop_edges]))]
+            edges.append(hop_edges)
+
+            # Next hop is expanded from the proteins not seen before:
+            neighbours = np.unique(self.targets[hop_edges])
+            frontier = neighbours[~visited[neighbours]]
+            visited[frontier] = True
+
+        edges = np.concatenate(edges)
+        return pd.DataFrame({
+            'uniprot_id': self.proteins[self.targets[edges]],
+            'interaction_identifier': self.interaction_ids[self.rows[edges]]
+        })
+
+
+def get_second_level_interactions(indirect_interactions_list, human_network, hops=1):
+    """
+    Based on the human interaction network, the interactions of the proteins
+    with the direct interactors of the COVID proteins are collected.
+
+    Output: pd.DataFrame
+    uniprot_id: uniprot identifiers
+    Covid_indirect_interactions: Intact network identifiers
+    """
+
+    # Get interactions of the direct interactors (~42k):
+    second_level_interactions = human_network.get_neighbours(indirect_interactions_list, hops=hops)
+
+    # Aggregating interactions by protein:
+    secondary_interactions = (
+        second_level_interactions
+        .groupby('uniprot_id', sort=False)
+        .interaction_identifier.agg(list)
+    )
+
+    # Return dataframe with indirect interactions:
+    return pd.DataFrame({'uniprot_id': secondary_interactions.index.tolist(),
+                       'Covid_indirect_interactions': secondary_interactions.tolist()})
 
 
 def get_all_implicated_interactions(network_df):
@@ -122,23 +196,14 @@ def get_all_implicated_interactions(network_df):
     return implicated_df
 
 
-def pool_arrays(s):
+def pool_interactions(merged, column):
     """
-    pd.Series -> serialized json
-    """
-    x = set()
-
-    for e in s:
-        try:
-            for a in e:
-                x.add(a)
-        except TypeError:
-            continue
+    Pooling the unique interaction identifiers of a list column by id.
 
-    if len(x) > 0:
-        return json.dumps(list(x))
-    else:
-        return np.nan
+    Output: pd.Series of lists indexed by id
+    """
+    exploded = merged[['id', column]].explode(column).dropna().drop_duplicates()
+    return exploded.groupby('id')[column].agg(list)
 
 
 def map_to_ensembl_gene_id(merged, id_map_df):
@@ -147,41 +212,51 @@ def map_to_ensembl_gene_id(merged, id_map_df):
     merged = merged.merge(id_map_df, how='left', on='uniprot_id')
 
     # Update id column when value is missing:
-    merged['id'] = merged.apply(lambda x: x['id'] if x['id'] == x['id'] else x['uniprot_id'], axis=1)
+    merged['id'] = merged['id'].fillna(merged['uniprot_id'])
     merged.drop(['uniprot_id'], axis=1, inplace=True)
 
     # Collapsing data:
-    collapsed = []
-    for gene_id, group in merged.groupby(['id']):
-        try:
-            collapsed.append({
-                'Implicated_in_viral_infection':group.Implicated_in_viral_infection.any(),
-                'id':gene_id,
-                'Covid_direct_interactions': pool_arrays(group.Covid_direct_interactions),
-                'Covid_indirect_interactions': pool_arrays(group.Covid_indirect_interactions)
-            })
-        except:
-            print(group)
-            raise
-    collapsed_df = pd.DataFrame(collapsed)
-    return collapsed_df
-
-
-def read_human_interactions(human_interactions_file):
-    """
-    Based on the Intact JSON dump file, a dataframe is built with all 
-    human protein-protein interactions.
+    collapsed_df = merged.groupby('id').Implicated_in_viral_infection.any().reset_index()
+    for column in ['Covid_direct_interactions', 'Covid_indirect_interactions']:
+        collapsed_df[column] = collapsed_df.id.map(pool_interactions(merged, column))
 
-    Columns:
-    interactor_a str uniprot id
-    interactor_b str uniprot id
-    interaction_identifier str intact id
+    return collapsed_df[['Implicated_in_viral_infection', 'id', 'Covid_direct_interactions', 'Covid_indirect_interactions']]
+
+
+def parse_human_interactions_chunk(human_interactions_file, start=0, end=None, min_score=0.45):
+    """
+    Parsing the lines of the Intact JSON dump file between the start and end byte offsets.
+    The offsets have to be aligned to line boundaries.
+
+    Output: tuple
+    proteins: list of uniprot ids in order of appearance
+    interactors_a: array of integer codes (position in the list of proteins)
+    interactors_b: array of integer codes (position in the list of proteins)
+    interaction_identifiers: list of intact ids
     """
 
-    all_human_interactions = []
-    with open(human_interactions_file,'r') as f:
+    # Uniprot ids are integer encoded while reading:
+    protein_codes = {}
+    interactors_a = array('i')
+    interactors_b = array('i')
+    interaction_identifiers = []
+
+    with open(human_interactions_file,'rb') as f:
+        f.seek(start)
+        position = start
+
         for line in f:
-            interaction = json.loads(line)
+
+            # Stop at the end of the chunk:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+
+            # Skip rows without any uniprot interactor before decoding the json:
+            if b'uniprotkb' not in line:
+                continue
+
+            interaction = loads_json(line)
 
             # Skip if interactors are missing:
             if (not interaction['interactorB']) or (not interaction['interactorA']):
@@ -198,53 +273,222 @@ def read_human_interactions(human_interactions_file):
                 continue
 
             # Skipping interaction with low score:
-            if interaction['interaction']['interaction_score'] < 0.45:
+            if interaction['interaction']['interaction_score'] < min_score:
                 continue
 
+            code_a = protein_codes.setdefault(interaction['interactorA']['id'].split('-')[0], len(protein_codes))
+            code_b = protein_codes.setdefault(interaction['interactorB']['id'].split('-')[0], len(protein_codes))
+
             # Looping through all evidence:
             for evidence in interaction['interaction']['evidence']:
+                interactors_a.append(code_a)
+                interactors_b.append(code_b)
+                interaction_identifiers.append(evidence['interaction_identifier'])
+
+    return list(protein_codes.keys()), interactors_a, interactors_b, interaction_identifiers
+
+
+def get_line_aligned_chunks(filename, chunk_count):
+    """
+    Splitting a newline delimited file into byte ranges aligned to line boundaries.
+
+    Output: list of (start, end) tuples
+    """
+
+    file_size = os.path.getsize(filename)
+    offsets = [0]
+
+    with open(filename, 'rb') as f:
+        for i in range(1, chunk_count):
+            offset = file_size * i // chunk_count
+
+            # Moving the offset to the beginning of the next line:
+            f.seek(max(offset - 1, 0))
+            f.readline()
+            offsets.append(max(f.tell(), offsets[-1]))
+
+    offsets.append(file_size)
 
-                all_human_interactions.append({
-                    'interactor_a':interaction['interactorA']['id'].split('-')[0],
-                    'interactor_b':interaction['interactorB']['id'].split('-')[0],
-                    'interaction_identifier': evidence['interaction_identifier']
-                })
+    # Empty chunks are dropped (at least one chunk is returned):
+    chunks = [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if start < end]
+    return chunks if chunks else [(0, file_size)]
+
+
+def read_human_interactions(human_interactions_file, min_score=0.45, workers=1):
+    """
+    Based on the Intact JSON dump file, a dataframe is built with all 
+    human protein-protein interactions.
+
+    The file is streamed and the values are collected into columnar arrays,
+    so the memory footprint depends on the number of retained interactions only.
+    If more than one worker is requested, line aligned chunks of the file are parsed in parallel.
+
+    Columns:
+    interactor_a category uniprot id
+    interactor_b category uniprot id
+    interaction_identifier str intact id
+    """
+
+    if workers > 1:
+        # Using more chunks than workers to balance the load:
+        chunks = get_line_aligned_chunks(human_interactions_file, workers * 4)
+        with Pool(workers) as pool:
+            parsed_chunks = pool.starmap(parse_human_interactions_chunk,
+                                         [(human_interactions_file, start, end, min_score) for start, end in chunks])
+    else:
+        parsed_chunks = [parse_human_interactions_chunk(human_interactions_file, min_score=min_score)]
+
+    # Re-encoding the chunk level protein codes to a common set of categories (in order of appearance):
+    chunk_codes, proteins = pd.factorize(pd.Series([protein for chunk in parsed_chunks for protein in chunk[0]], dtype=object))
+
+    interactors_a = []
+    interactors_b = []
+    offset = 0
+    for chunk_proteins, chunk_interactors_a, chunk_interactors_b, _ in parsed_chunks:
+        code_map = chunk_codes[offset: offset + len(chunk_proteins)]
+        interactors_a.append(code_map[np.frombuffer(chunk_interactors_a, dtype=np.intc)])
+        interactors_b.append(code_map[np.frombuffer(chunk_interactors_b, dtype=np.intc)])
+        offset += len(chunk_proteins)
 
     # return dataframe with all human interactions (~520k)
-    return pd.DataFrame(all_human_interactions)
+    return pd.DataFrame({
+        'interactor_a': pd.Categorical.from_codes(np.concatenate(interactors_a), categories=proteins),
+        'interactor_b': pd.Categorical.from_codes(np.concatenate(interactors_b), categories=proteins),
+        'interaction_identifier': [identifier for chunk in parsed_chunks for identifier in chunk[3]]
+    })
+
+
+def extract_from_categories(series, pattern, expand=True):
+    """
+    Applies str.extract on the categories of a categorical series only, then the
+    result is mapped back to the rows by the category codes.
+    """
+    extracted = pd.Series(series.cat.categories).str.extract(pattern, expand=expand)
+
+    # Missing values (code -1) are not found in the index, so they will be NaN:
+    extracted = extracted.reindex(series.cat.codes.to_numpy())
+    extracted.index = series.index
+
+    return extracted
 
 
 def read_and_filter_covid_interactions(network_file):
 
-    # Reading tsv file:
-    network_df = pd.read_csv(network_file, sep='\t')
+    # Reading only the required MITAB 2.7 columns (interactor and taxonomy values are highly redundant, so stored as categories):
+    interactor_columns = ['#ID(s) interactor A', 'ID(s) interactor B', 'Taxid interactor A', 'Taxid interactor B']
+    network_df = pd.read_csv(network_file, sep='\t', usecols=interactor_columns + ['Interaction identifier(s)'],
+                             dtype={column: 'category' for column in interactor_columns})
+
+    # Parse source and interactor id (removing protein suffix) eg. uniprotkb:P0DTC2-PRO_0000449647:
+    for side, column in [('a', '#ID(s) interactor A'), ('b', 'ID(s) interactor B')]:
+        interactor = extract_from_categories(network_df[column], r'^([^:]*):([^:-]*)')
+        network_df['source_' + side] = interactor[0]
+        network_df['id_' + side] = interactor[1]
 
     # Drop rows where the source is other than uniprot:
-    network_df['source_a'] = network_df['#ID(s) interactor A'].apply(lambda x: x.split(':')[0])
-    network_df['source_b'] = network_df['ID(s) interactor B'].apply(lambda x: x.split(':')[0])
     network_df = network_df.loc[(network_df.source_a == 'uniprotkb') & (network_df.source_b == 'uniprotkb')]
 
-    # Parse taxonomy IDs:
-    network_df['taxid_a'] = network_df['Taxid interactor A'].apply(parse_organism)
-    network_df['taxid_b'] = network_df['Taxid interactor B'].apply(parse_organism)
+    # Parse taxonomy IDs (from the second value if more provided eg. taxid:10090(mouse)|taxid:10090(Mus musculus)):
+    taxid_pattern = r'^(?:[^|]*\|)?[^|]*?taxid:(-*\d+)'
+    network_df['taxid_a'] = extract_from_categories(network_df['Taxid interactor A'], taxid_pattern, expand=False)
+    network_df['taxid_b'] = extract_from_categories(network_df['Taxid interactor B'], taxid_pattern, expand=False)
 
     # Parse interaction identifier:
     network_df['interaction_id'] = (network_df['Interaction identifier(s)']
-        .apply(lambda x: x.split('|')[0].replace('intact:','')))
- 
-    # Parse interactor id: removing protein suffix:
-    network_df['id_a'] = network_df['#ID(s) interactor A'].apply(lambda x: x.split(':')[1].split('-')[0])
-    network_df['id_b'] = network_df['ID(s) interactor B'].apply(lambda x: x.split(':')[1].split('-')[0])
+        .str.extract(r'^([^|]*)', expand=False)
+        .str.replace('intact:', '', regex=False))
 
     return network_df[['id_a','taxid_a','id_b','taxid_b','interaction_id']]
 
 
+def save_table_cache(df, cache_file, cache_key):
+    """
+    Saving a table of string columns into a numpy .npz file.
+    Each column is stored as integer codes and categories.
+    """
+    arrays = {
+        'key': np.array(cache_key),
+        'columns': np.array(df.columns.tolist())
+    }
+
+    for i, column in enumerate(df.columns):
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            codes, categories = df[column].cat.codes.to_numpy(), df[column].cat.categories
+            arrays['categorical_{}'.format(i)] = np.array(True)
+        else:
+            codes, categories = pd.factorize(df[column])
+            arrays['categorical_{}'.format(i)] = np.array(False)
+
+        arrays['codes_{}'.format(i)] = codes.astype(np.int32)
+        arrays['categories_{}'.format(i)] = np.array(categories.astype(str).tolist(), dtype=str)
+
+    # Writing to a temporary file first, so an interrupted run leaves no broken cache behind:
+    temp_file = cache_file + '.tmp.npz'
+    np.savez(temp_file, **arrays)
+    os.replace(temp_file, cache_file)
+
+
+def load_table_cache(cache_file, cache_key):
+    """
+    Loading a table saved by save_table_cache. None is returned if the cache
+    file is missing or was built with a different key.
+    """
+    if not os.path.isfile(cache_file):
+        return None
+
+    with np.load(cache_file) as cache:
+        if str(cache['key']) != cache_key:
+            return None
+
+        table = {}
+        for i, column in enumerate(cache['columns'].tolist()):
+            values = pd.Categorical.from_codes(cache['codes_{}'.format(i)], categories=cache['categories_{}'.format(i)].tolist())
+            table[column] = values if cache['categorical_{}'.format(i)] else values.astype(object)
+
+    return pd.DataFrame(table)
+
+
+def read_with_cache(reader, input_file, cache_dir=None, parameters=None, options=None):
+    """
+    Reads the input file with the reader function unless a cached table is found
+    that was built from the same file with the same parameters. Stale cache files are overwritten.
+
+    parameters: arguments of the reader that change the output (part of the cache key)
+    options: arguments of the reader that do not change the output
+    """
+    parameters = parameters if parameters else {}
+    options = options if options else {}
+
+    # Cache is not used:
+    if cache_dir is None:
+        return reader(input_file, **parameters, **options)
+
+    cache_key = json.dumps({
+        'file': get_source_fingerprint(input_file, sample_size=1 << 20),
+        'reader': reader.__name__,
+        'parameters': parameters
+    }, sort_keys=True)
+    cache_file = os.path.join(cache_dir, '{}.npz'.format(reader.__name__))
+
+    table = load_table_cache(cache_file, cache_key)
+    if table is not None:
+        print('[Info] Using cached table: {}'.format(cache_file))
+        return table
+
+    table = reader(input_file, **parameters, **options)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    save_table_cache(table, cache_file, cache_key)
+
+    return table
+
+
 def read_and_filter_uniprot_map_file(id_map_file):
     id_map_df = pd.read_csv(id_map_file, sep='\t', names=['uniprot','source','id'])
     return id_map_df.loc[id_map_df.source == 'Ensembl']
 
 
-if __name__ == '__main__':
+def main():
 
     # Parsing commandline arguments
     parser = argparse.ArgumentParser()
@@ -254,12 +498,27 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output', help='Output file name.', type=str)
     parser.add_argument('-f', '--full', help='Human interactions file name.', type=str)
     parser.add_argument('-m', '--mapfile', help='Uniprot ID map file.', type=str)
+    parser.add_argument('--indexdir', help='Folder of the id mapping indexes (default: id_mapping_index folder next to the Uniprot ID map file).', type=str)
+    parser.add_argument('-w', '--workers', help='Number of processes used to parse the human interactions file.', type=int, default=1)
+    parser.add_argument('--cachedir', help='Folder to store the parsed interaction tables (default: intact_cache folder next to the human interactions file).', type=str)
+    parser.add_argument('--nocache', help='Read and parse the input files even if cached tables are available.', action='store_true')
+    parser.add_argument('-k', '--hops', help='Number of hops to expand the network of the direct interactors.', type=int, choices=[1, 2, 3], default=1)
     args = parser.parse_args()
 
     network_file = args.input
     output_file = args.output
     id_map_file = args.mapfile
     human_interactions = args.full
+    hops = args.hops
+    workers = args.workers
+
+    # Cache folder of the parsed tables:
+    if args.nocache:
+        cache_dir = None
+    elif args.cachedir:
+        cache_dir = args.cachedir
+    else:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(human_interactions)), 'intact_cache')
 
     ##
     ## Reading input files:
@@ -267,17 +526,13 @@ if __name__ == '__main__':
 
     # Reading human interactions:
     print('[Info] Reading all human interactions...')
-    human_interactions_df = read_human_interactions(human_interactions)
-
-    # Reading id mapping file:
-    print('[Info] Reading and filtering uniprot mapfile...')
-    # uniprot_id    ensembl_id
-    id_map_df = pd.read_csv(id_map_file, sep='\t')
-    id_map_df.rename(columns={'ensembl_id':'id'}, inplace=True)
+    human_interactions_df = read_with_cache(read_human_interactions, human_interactions, cache_dir,
+                                            parameters={'min_score': 0.45}, options={'workers': workers})
+    human_network = InteractionNetwork(human_interactions_df)
 
     # Reading covid network file:
     print('[Info] Reading and filtering COVID related interactions...')
-    network_df = read_and_filter_covid_interactions(network_file)
+    network_df = read_with_cache(read_and_filter_covid_interactions, network_file, cache_dir)
 
     ##
     ## Process data:
@@ -292,7 +547,7 @@ if __name__ == '__main__':
 
     # Get indirect interactors:
     print('[Info] Generating table with indirect interactors of COVID proteins...')
-    indirect_interactions_df = get_second_level_interactions(indirect_interactions_list, human_interactions_df)
+    indirect_interactions_df = get_second_level_interactions(indirect_interactions_list, human_network, hops=hops)
     print('[Info] Number of indirect interactions: {}'.format(len(indirect_interactions_df)))
 
     # Mark any human proteins implicated in viral pathogenesis:
@@ -311,10 +566,18 @@ if __name__ == '__main__':
 
     # Adding Ensembl IDs:
     print('[Info] Adding Ensembl gene IDs.')
+    id_mapper = IdMapper(args.indexdir or get_default_index_dir(id_map_file), uniprot_map_file=id_map_file)
+    id_map_df = id_mapper.map_uniprot(merged.uniprot_id.unique()).rename(columns={'ensembl_id': 'id'})
     final_df = map_to_ensembl_gene_id(merged,id_map_df)
     print('[Info] Number of primary + secondary interactions: {}'.format(len(final_df)))
 
+    # Save interaction lists as valid JSON strings:
+    for column in ['Covid_direct_interactions', 'Covid_indirect_interactions']:
+        final_df[column] = final_df[column].apply(lambda x: json.dumps(x) if isinstance(x, list) else x)
+
     # Save output file:
     final_df.to_csv(output_file, sep='\t', index=False)
 
 
+if __name__ == '__main__':
+    main()
@@ -1,61 +1,102 @@
 import pandas as pd
+import numpy as np
 import json
-import gzip
 import argparse
+from id_mapping import IdMapper, get_default_index_dir
 
 
-def get_ensembl_gene_set(ensembl_file):
-    
-    data = []
+def encode_numbers(values):
+    """
+    Returns the JSON encoding of the numbers, as written by json.dumps.
+    """
+    values = np.asarray(values)
+    encoded = values.astype(str).astype(object)
 
-    # Reading ensembl json file:
-    with gzip.open(ensembl_file) as f:
-        for line in f:
-            data.append(json.loads(line))
-            
-    df = pd.DataFrame(data)
-    return df[['id','name']]
-    
+    if values.dtype.kind == 'f':
+        encoded[np.isnan(values)] = 'NaN'
+        encoded[values == np.inf] = 'Infinity'
+        encoded[values == -np.inf] = '-Infinity'
 
-def table_formatter(row):
+    return encoded
+
+
+def encode_strings(values):
+    """
+    Returns the JSON encoding of the strings, each distinct value is serialized once.
+    """
+    codes, uniques = pd.factorize(values)
+    encoded = np.array([json.dumps(value) for value in uniques] + ['NaN'], dtype=object)
+    return encoded[codes]
+
+
+def round_numbers(values, digits=3):
+    """
+    Rounds the numbers as Python's round does, each distinct value is rounded once.
+    Series.round gives different results for some ties, eg.:
+
+    >>> round_numbers([-0.1265, 0.0005, float('nan')]).tolist()
+    [-0.127, 0.001, nan]
+    """
+    codes, uniques = pd.factorize(np.asarray(values, dtype=float))
+    rounded = np.array([round(value, digits) for value in uniques.tolist()] + [np.nan])
+    return rounded[codes]
+
+
+def table_formatter(mr_df):
+    """
+    Returns the gene name, the sort keys and the JSON objects of the MR and colocalisation fields of each row.
+    """
 
     ## Generating field for MR data:
-    
-    # Formatting dataset description:
-    dataset = row['COVID_dataset'].replace('_',' ')
-    dataset = dataset.replace('covid', f'covid (N={row["n_cases"]:,})',1)
-    dataset = dataset + f" (N={row['n_controls']:,})"
-    dataset = dataset.capitalize()
-    
+
+    # Formatting dataset descriptions, once for each dataset:
+    datasets = mr_df[['COVID_dataset', 'n_cases', 'n_controls']].drop_duplicates()
+    parts = datasets.COVID_dataset.str.replace('_', ' ').str.partition('covid')
+    n_cases = datasets.n_cases.map('{:,}'.format).where(parts[1] != '', None)
+    n_controls = datasets.n_controls.map('{:,}'.format)
+    datasets['dataset'] = encode_strings(
+        (parts[0] + parts[1] + (' (N=' + n_cases + ')').fillna('') + parts[2] + ' (N=' + n_controls + ')').str.capitalize()
+    )
+    dataset = mr_df[datasets.columns[:3]].merge(datasets, how='left').dataset.values
+
     # Round p-value:
-    pval = round(row['pval'],3) if row['pval'] > 0.01 else f'{row["pval"]:.2E}'
-    
-    mr_data = { 
-        'Dataset': dataset,
-        'Number of SNPs': row['nSNPs'],
-        'MR estimate': round(row['MR_estimate'],3),
-        'Lower conf.int': round(row['lower_ci'],3),
-        'Upper conf.int': round(row['upper_ci'],3),
-        'p-value': pval
-    }
-    
+    pval = np.where(
+        mr_df.pval > 0.01,
+        encode_numbers(round_numbers(mr_df.pval)),
+        '"' + np.char.mod('%.2E', mr_df.pval.values).astype(object) + '"'
+    )
+
+    mr_data = (
+        '{"Dataset": ' + dataset +
+        ', "Number of SNPs": ' + encode_numbers(mr_df.nSNPs) +
+        ', "MR estimate": ' + encode_numbers(round_numbers(mr_df.MR_estimate)) +
+        ', "Lower conf.int": ' + encode_numbers(round_numbers(mr_df.lower_ci)) +
+        ', "Upper conf.int": ' + encode_numbers(round_numbers(mr_df.upper_ci)) +
+        ', "p-value": ' + pval + '}'
+    )
+
     # Generate field for colocalization:
-    coloc_data = {
-        'Dataset': dataset,
-        'Candidate SNP': row['colocalising_SNP'],
-        'Posterior probability': row['coloc_posterior_probability_H4']
-    }
-    
-    # Initialize return value:
-    returnvalue = {
-        'gene_name': row['Gene_or_Protein'].split('_')[0],
+    coloc_data = (
+        '{"Dataset": ' + dataset +
+        ', "Candidate SNP": ' + encode_strings(mr_df.colocalising_SNP) +
+        ', "Posterior probability": ' + encode_numbers(mr_df.coloc_posterior_probability_H4) + '}'
+    )
+
+    return pd.DataFrame({
+        'gene_name': mr_df.Gene_or_Protein.str.split('_').str[0],
         'MR_field': mr_data,
         'colocalisation': coloc_data,
-        'pval': row['pval'],
-        'coloc_posterior_probability_H4': row['coloc_posterior_probability_H4']
-    }
-    
-    return returnvalue
+        'pval': mr_df.pval,
+        'coloc_posterior_probability_H4': mr_df.coloc_posterior_probability_H4
+    })
+
+
+def pool_field(merged, field, sort_column, ascending):
+    """
+    Returns the JSON lists of the field for each gene, sorted by the given column within the gene.
+    """
+    sorted_df = merged.sort_values(['id', sort_column], ascending=[True, ascending], kind='stable')
+    return '[' + sorted_df.groupby('id', sort=True)[field].agg(', '.join) + ']'
 
 
 def main():
@@ -67,15 +108,15 @@ def main():
     parser.add_argument('-i', '--input', help='CSV with the MR table.', required=True, type=str)
     parser.add_argument('-o', '--output', help='Output tsv file of the parsed MR data.', required=True, type=str)
     parser.add_argument('-e', '--ensembl', help='Parsed ensembl file for gene name mapping.', required=True, type=str)
+    parser.add_argument('--indexdir', help='Folder of the id mapping indexes (default: id_mapping_index folder next to the ensembl file).', type=str)
 
     args = parser.parse_args()
     mr_file = args.input
     mr_file_parsed = args.output 
     es_file = args.ensembl
 
-    # Get dataframe for ID mapping:
-    print('[Info] Reading list of Ensembl genes.')
-    ensembl_df = get_ensembl_gene_set(es_file)
+    # Gene name to Ensembl id mapper:
+    id_mapper = IdMapper(args.indexdir or get_default_index_dir(es_file), ensembl_file=es_file)
 
     # Reading MR dataset:
     print('[Info] Reading table with the results of MR.')
@@ -102,25 +143,19 @@ def main():
 
     # Format data:
     print('[Info] Formatting data.')
-    formatted_data = mr_df.apply(table_formatter, axis=1)
-    MR_formatted_df= pd.DataFrame(formatted_data.tolist())
+    MR_formatted_df = table_formatter(mr_df)
 
     # Merge tables:
     print('[Info] Adding Ensembl gene IDs to table and save.')
+    ensembl_df = id_mapper.map_symbol(MR_formatted_df.gene_name.unique()).rename(columns={'ensembl_id': 'id'})
     merged = ensembl_df.merge(MR_formatted_df, how='inner', left_on='name', right_on='gene_name')
 
     # As the id column is not unique, we have to pool the MR results:
-    pooled_data = []
-    for gene_id, group in merged.groupby('id'):
-
-        pooled_data.append({
-            'id': gene_id,
-            'MR_field': json.dumps(group.sort_values('pval',ascending=True).MR_field.tolist()),
-            'colocalisation': json.dumps(group.sort_values('coloc_posterior_probability_H4',ascending=False).colocalisation.tolist())
-        })
+    pooled_df = pd.DataFrame({
+        'MR_field': pool_field(merged, 'MR_field', 'pval', True),
+        'colocalisation': pool_field(merged, 'colocalisation', 'coloc_posterior_probability_H4', False)
+    }).reset_index()
 
-    pooled_df = pd.DataFrame(pooled_data)
-    
     # Save data:
     pooled_df.to_csv(mr_file_parsed, sep='\t', index=False, doublequote=False, quotechar="'")
 
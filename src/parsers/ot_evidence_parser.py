@@ -0,0 +1,255 @@
+import argparse
+import gzip
+import json
+from collections import deque
+from decimal import Decimal
+from multiprocessing import Pool
+
+"""
+Extracting the drug and literature evidence from the Open Targets evidence dump in a single pass.
+
+The dump is read as a stream of line aligned blocks, which are decoded by a pool of workers.
+Only lines containing the byte patterns of a sink are decoded, the rows of each sink are
+written in the order of the input file, formatted the same way as jq's @tsv.
+"""
+
+# Size of the decompressed blocks sent to the workers:
+BLOCK_SIZE = 16 * 1024 * 1024
+
+# Prefix of the ChEMBL drug ids, removed from the drug evidence:
+CHEMBL_PREFIX = 'http://identifiers.org/chembl.compound/'
+
+
+def get_field(data, *keys):
+    """
+    Returns the value at the path of keys, None if a key is missing.
+    Raises a ValueError if a value on the path is not an object (jq fails on these records).
+    """
+    for key in keys:
+        if data is None:
+            return None
+        if not isinstance(data, dict):
+            raise ValueError('Cannot index {} with "{}"'.format(type(data).__name__, key))
+        data = data.get(key)
+
+    return data
+
+
+def iterate_values(data):
+    """
+    Returns the values of an array or object, as jq's .[] does.
+    """
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict):
+        return list(data.values())
+
+    raise ValueError('Cannot iterate over {}'.format(type(data).__name__))
+
+
+def format_number(number):
+    """
+    Formatting a number as jq does: as a double, with the shortest representation.
+    """
+    number = float(number)
+    if number == 0:
+        return '-0' if str(number).startswith('-') else '0'
+
+    sign, digits, exponent = Decimal(repr(number)).normalize().as_tuple()
+    digits = ''.join(str(digit) for digit in digits)
+    decimal_point = len(digits) + exponent
+
+    # Exponential notation for very small and very large numbers:
+    if decimal_point <= -4 or decimal_point > len(digits) + 15:
+        mantissa = digits[0] + ('.' + digits[1:] if len(digits) > 1 else '')
+        formatted = '{}e{:+03d}'.format(mantissa, decimal_point - 1)
+    elif decimal_point <= 0:
+        formatted = '0.' + '0' * -decimal_point + digits
+    elif decimal_point >= len(digits):
+        formatted = digits + '0' * (decimal_point - len(digits))
+    else:
+        formatted = digits[:decimal_point] + '.' + digits[decimal_point:]
+
+    return '-' + formatted if sign else formatted
+
+
+def format_tsv_value(value):
+    """
+    Formatting a value of a tsv row as jq's @tsv does.
+    """
+    if value is None:
+        return ''
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    if isinstance(value, (int, float)):
+        return format_number(value)
+
+    raise ValueError('{} is not valid in a csv row'.format(type(value).__name__))
+
+
+def format_drug_evidence(evidence):
+    """
+    Target, disease, drug, clinical phase, action type and molecule name of the ChEMBL evidence.
+    """
+    if get_field(evidence, 'sourceID') != 'chembl':
+        return None
+
+    row = '\t'.join(format_tsv_value(value) for value in [
+        get_field(evidence, 'target', 'id'),
+        get_field(evidence, 'disease', 'id'),
+        get_field(evidence, 'drug', 'id'),
+        get_field(evidence, 'evidence', 'drug2clinic', 'clinical_trial_phase', 'numeric_index'),
+        get_field(evidence, 'evidence', 'target2drug', 'action_type'),
+        get_field(evidence, 'drug', 'molecule_name')
+    ])
+
+    return row.replace(CHEMBL_PREFIX, '')
+
+
+def format_covid_literature(evidence):
+    """
+    Target, disease and the referenced literature of the Europe PMC evidence of COVID-19.
+    """
+    if get_field(evidence, 'sourceID') != 'europepmc' or get_field(evidence, 'disease', 'id') != 'MONDO_0100096':
+        return None
+
+    references = iterate_values(get_field(evidence, 'literature', 'references'))
+    values = [get_field(evidence, 'target', 'id'), get_field(evidence, 'disease', 'id')]
+    values += [get_field(reference, 'lit_id') for reference in references]
+
+    return '\t'.join(format_tsv_value(value) for value in values)
+
+
+# Sinks: byte patterns required in the line and the row formatter of the evidence:
+EVIDENCE_SINKS = {
+    'drugEvidence': ([b'"chembl"'], format_drug_evidence),
+    'covidLiterature': ([b'"europepmc"', b'"MONDO_0100096"'], format_covid_literature)
+}
+
+
+def parse_evidence_block(block, sink_names):
+    """
+    Parsing the evidence lines of a block for the given sinks.
+
+    Output: (list of the encoded rows of each sink, number of lines that could not be parsed)
+    """
+    sinks = [EVIDENCE_SINKS[sink_name] for sink_name in sink_names]
+    rows = [[] for _ in sinks]
+    failed = 0
+
+    for line in block.split(b'\n'):
+
+        # Cheap check on the raw line before decoding:
+        matching_sinks = [i for i, (patterns, _) in enumerate(sinks) if all(pattern in line for pattern in patterns)]
+        if not matching_sinks:
+            continue
+
+        try:
+            evidence = json.loads(line)
+            for i in matching_sinks:
+                row = sinks[i][1](evidence)
+                if row is not None:
+                    rows[i].append(row + '\n')
+        except ValueError:
+            failed += 1
+
+    return [encode_rows(sink_rows) for sink_rows in rows], failed
+
+
+def encode_rows(rows):
+    """
+    Encoding the rows in UTF-8, unpaired surrogates (from escapes in the json) are replaced as jq does.
+    """
+    text = ''.join(rows)
+    try:
+        return text.encode('utf-8')
+    except UnicodeEncodeError:
+        return text.encode('utf-16', 'surrogatepass').decode('utf-16', 'replace').encode('utf-8')
+
+
+def read_line_blocks(input_file, block_size=BLOCK_SIZE):
+    """
+    Reading the (optionally gzipped) file in blocks of complete lines.
+    """
+    opener = gzip.open if input_file.endswith('.gz') else open
+    with opener(input_file, 'rb') as f:
+        remainder = b''
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+
+            # Keeping the partial last line for the next block:
+            end = data.rfind(b'\n')
+            if end < 0:
+                remainder += data
+                continue
+
+            yield remainder + data[:end]
+            remainder = data[end + 1:]
+
+        if remainder:
+            yield remainder
+
+
+def main():
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Extract drug and literature evidence from the Open Targets evidence dump in a single pass.')
+
+    parser.add_argument('-i', '--input', help='Open Targets evidence file (json lines, optionally gzipped).', required=True, type=str)
+    parser.add_argument('-d', '--drugEvidence', help='Output tsv file of the ChEMBL drug evidence.', type=str)
+    parser.add_argument('-l', '--covidLiterature', help='Output tsv file of the Europe PMC COVID-19 literature evidence.', type=str)
+    parser.add_argument('-w', '--workers', help='Number of processes decoding the evidence.', type=int, default=1)
+
+    args = parser.parse_args()
+
+    # Get parameters:
+    input_file = args.input
+    workers = args.workers
+    outputs = {sink_name: getattr(args, sink_name) for sink_name in EVIDENCE_SINKS if getattr(args, sink_name)}
+
+    if not outputs:
+        parser.error('At least one output file is required.')
+
+    sink_names = list(outputs.keys())
+    output_files = [open(outputs[sink_name], 'wb') for sink_name in sink_names]
+    failed = 0
+
+    def write_rows(parsed_block):
+        nonlocal failed
+        sink_rows, block_failed = parsed_block
+        for f, rows in zip(output_files, sink_rows):
+            f.write(rows)
+        failed += block_failed
+
+    print('[Info] Extracting evidence from {}'.format(input_file))
+    try:
+        if workers > 1:
+            # The number of blocks in progress is limited, so the input is not read ahead into memory:
+            with Pool(workers) as pool:
+                pending = deque()
+                for block in read_line_blocks(input_file):
+                    pending.append(pool.apply_async(parse_evidence_block, (block, sink_names)))
+                    if len(pending) >= workers * 2:
+                        write_rows(pending.popleft().get())
+
+                while pending:
+                    write_rows(pending.popleft().get())
+        else:
+            for block in read_line_blocks(input_file):
+                write_rows(parse_evidence_block(block, sink_names))
+    finally:
+        for f in output_files:
+            f.close()
+
+    if failed:
+        print('[Warning] {} evidence lines could not be parsed and were skipped.'.format(failed))
+
+
+if __name__ == '__main__':
+    main()
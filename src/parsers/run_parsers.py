@@ -0,0 +1,370 @@
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+"""
+Running the parsers as a pipeline of stages.
+
+The file dependencies of the stages form a DAG: a stage is started as soon as the stages producing
+its inputs are finished, independent stages are running concurrently in a pool of processes.
+The Python parsers are imported and their main function is called in the pool processes, so the
+interpreter and the libraries are only started once for each process.
+
+A stage is skipped if the content of its inputs, its code and its arguments are the same as in the
+last successful run, and its outputs were not changed since. The content hashes are cached by file
+size and modification time, so unchanged files are not read again.
+"""
+
+# Folder of the parsers:
+PARSERS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules shared by the Python parsers, a change in them reruns all Python stages:
+SHARED_MODULES = ['id_mapping.py', 'ensembl_lookup.py']
+
+# Stage of the pipeline: the script with its arguments, the input and output files.
+# The R scripts are run as subprocesses, quiet R scripts have their standard output discarded.
+Stage = namedtuple('Stage', ['name', 'script', 'arguments', 'inputs', 'outputs', 'quiet'])
+
+
+def get_stages(files, workers):
+    """
+    Returns the stages of the parsers. The files are given by their Makefile variable names,
+    a KeyError is raised if a file is not given.
+    """
+    f = files
+    return [
+        Stage('ensembl', 'ensembl_parser.py',
+              ['-i', f['ENSEMBL'], '-o', f['ENSEMBLPARSED'], '-m', f['UNIPROT2ENSEMBLDRAFT'], '-t', f['OTTARGETLIST'],
+               '-p', f['ENSEMBLPARSEDTABLE'], '-w', str(workers)],
+              [f['ENSEMBL'], f['OTTARGETLIST']], [f['ENSEMBLPARSED'], f['ENSEMBLPARSEDTABLE'], f['UNIPROT2ENSEMBLDRAFT']], False),
+        Stage('uniprot2ensembl', 'Ensembl-Uniprot_map_generator.py',
+              ['-u', f['UNIPROTIDMAPPING'], '-e', f['UNIPROT2ENSEMBLDRAFT'], '-o', f['UNIPROT2ENSEMBL']],
+              [f['UNIPROTIDMAPPING'], f['UNIPROT2ENSEMBLDRAFT']], [f['UNIPROT2ENSEMBL']], False),
+        Stage('uniprot', 'uniprot_parser.py',
+              ['-i', f['UNIPROTCOVIDFLATFILE'], '-o', f['UNIPROTCOVIDPARSED'], '-m', f['UNIPROT2ENSEMBL'], '-c', f['ENSEMBLXREFCACHE']],
+              [f['UNIPROTCOVIDFLATFILE'], f['UNIPROT2ENSEMBL']], [f['UNIPROTCOVIDPARSED']], False),
+        Stage('ot_evidence', 'ot_evidence_parser.py',
+              ['-i', f['OTEVIDENCE'], '-d', f['OTDRUGEVIDENCE'], '-l', f['OTLITERATUREPARSED'], '-w', str(workers)],
+              [f['OTEVIDENCE']], [f['OTDRUGEVIDENCE'], f['OTLITERATUREPARSED']], False),
+        Stage('ot_literature', 'literature_get.R',
+              [f['OTLITERATUREPARSED'], f['OTLITERATUREPREFORMATED']],
+              [f['OTLITERATUREPARSED']], [f['OTLITERATUREPREFORMATED']], False),
+        Stage('complex', 'complex_parser.py',
+              ['-i', f['COVIDCOMPLEX'], '-o', f['COVIDCOMPLEXPARSED']],
+              [f['COVIDCOMPLEX']], [f['COVIDCOMPLEXPARSED']], False),
+        Stage('complex_portal', 'complex_portal_parser.py',
+              ['-i', f['COVIDCOMPLEXPARSED'], '-o', f['COMPLEXPREFORMATTED'], '-m', f['UNIPROT2ENSEMBL'], '-c', f['ENSEMBLXREFCACHE']],
+              [f['COVIDCOMPLEXPARSED'], f['UNIPROT2ENSEMBL']], [f['COMPLEXPREFORMATTED']], False),
+        Stage('intact', 'intact_parser.py',
+              ['-i', f['INTACTCOVID'], '-o', f['INTACTCOVIDPARSED'], '-m', f['UNIPROT2ENSEMBL'], '-f', f['INTACTHUMAN']],
+              [f['INTACTCOVID'], f['UNIPROT2ENSEMBL'], f['INTACTHUMAN']], [f['INTACTCOVIDPARSED']], False),
+        Stage('baseline', 'baseline_parser.py',
+              ['-i', f['OTBASELINE'], '-m', f['OTBASELINETISSUEMAP'], '-o', f['OTBASELINEPARSED']],
+              [f['OTBASELINE'], f['OTBASELINETISSUEMAP']], [f['OTBASELINEPARSED']], False),
+        Stage('hpa', 'hpa_parser.py',
+              ['-i', f['HPA'], '-o', f['HPAPREFORMATTED']],
+              [f['HPA']], [f['HPAPREFORMATTED']], False),
+        Stage('druginfo', 'target_druginfo_parser.py',
+              ['-i', f['OTDRUGEVIDENCE'], '--emit', 'target=' + f['DRUGFORTARGETPARSED'], '--emit', 'drug=' + f['DRUGSPARSED'],
+               '--emit', 'covid19_trials=' + f['DRUGSCOVID19TRIALSPARSED']],
+              [f['OTDRUGEVIDENCE']], [f['DRUGFORTARGETPARSED'], f['DRUGSPARSED'], f['DRUGSCOVID19TRIALSPARSED']], False),
+        Stage('tractability', 'tractability_parser.py',
+              ['-i', f['OTTRACTABILITY'], '-o', f['OTTRACTABILITYPARSED']],
+              [f['OTTRACTABILITY']], [f['OTTRACTABILITYPARSED']], False),
+        Stage('safety', 'safety_parser.py',
+              ['-k', f['OTKNOWNTARGETSAFETY'], '-e', f['OTEXPERIMENTALTOXICITY'], '-g', f['ENSEMBLPARSED'], '-o', f['OTSAFETYPARSED'], '-a'],
+              [f['OTKNOWNTARGETSAFETY'], f['OTEXPERIMENTALTOXICITY'], f['ENSEMBLPARSED']], [f['OTSAFETYPARSED']], False),
+        Stage('abundances', 'abundances_get.R',
+              [f['COVIDABUNDACESRAW'], f['UNIPROT2ENSEMBL'], f['COVIDABUNDANCES']],
+              [f['COVIDABUNDACESRAW'], f['UNIPROT2ENSEMBL']], [f['COVIDABUNDANCES']], True),
+        Stage('mr', 'mr_parser.py',
+              ['-i', f['MR_FILE'], '-o', f['MRPREFORMATED'], '-e', f['ENSEMBLPARSED']],
+              [f['MR_FILE'], f['ENSEMBLPARSED']], [f['MRPREFORMATED']], False),
+        Stage('covid_trials', 'covid_trials.R',
+              [f['UNIPROT2ENSEMBL'], f['DRUGFILE'], f['MOA_FILE'], f['COVID_TARGET_TRIALS'], f['COVID_TARGET_INVITRO']],
+              [f['UNIPROT2ENSEMBL'], f['DRUGFILE'], f['MOA_FILE']], [f['COVID_TARGET_TRIALS'], f['COVID_TARGET_INVITRO']], True),
+    ]
+
+
+def get_dependencies(stages):
+    """
+    Returns the names of the stages producing the inputs of each stage.
+    """
+    producers = {output: stage.name for stage in stages for output in stage.outputs}
+    return {
+        stage.name: sorted({producers[input_file] for input_file in stage.inputs if input_file in producers})
+        for stage in stages
+    }
+
+
+def get_required_stages(stages, dependencies, selected):
+    """
+    Returns the selected stages and all the stages they depend on, in the order of the stage list.
+    """
+    required = set()
+    pending = list(selected)
+    while pending:
+        name = pending.pop()
+        if name not in required:
+            required.add(name)
+            pending.extend(dependencies[name])
+
+    return [stage for stage in stages if stage.name in required]
+
+
+class FileHashes(object):
+    """
+    Content hashes of files, cached by size and modification time.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache or {}
+
+    def get(self, filename):
+        """
+        Returns the hash of the file, None if the file doesn't exist.
+        """
+        try:
+            file_stat = os.stat(filename)
+        except OSError:
+            return None
+
+        key = os.path.abspath(filename)
+        cached = self.cache.get(key)
+        if cached and cached['size'] == file_stat.st_size and cached['mtime'] == file_stat.st_mtime_ns:
+            return cached['hash']
+
+        file_hash = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                file_hash.update(block)
+
+        self.cache[key] = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns, 'hash': file_hash.hexdigest()}
+        return self.cache[key]['hash']
+
+
+def get_stage_key(stage, file_hashes):
+    """
+    Returns the hash of the code, arguments and input contents of the stage.
+    """
+    code = [os.path.join(PARSERS_DIR, stage.script)]
+    if stage.script.endswith('.py'):
+        code += [os.path.join(PARSERS_DIR, module) for module in SHARED_MODULES]
+
+    key = {
+        'code': [file_hashes.get(filename) for filename in code],
+        'arguments': stage.arguments,
+        'inputs': [file_hashes.get(filename) for filename in stage.inputs]
+    }
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+def is_up_to_date(stage, key, state, file_hashes):
+    """
+    Checks if the stage was run with the same key and its outputs were not changed since.
+    """
+    stage_state = state.get(stage.name)
+    if stage_state is None or stage_state['key'] != key:
+        return False
+
+    return all(file_hashes.get(output) == stage_state['outputs'].get(output) for output in stage.outputs)
+
+
+def load_module(script):
+    """
+    Imports the parser script as a module (once per process).
+    """
+    name = os.path.splitext(script)[0]
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(PARSERS_DIR, script))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+
+    return sys.modules[name]
+
+
+def run_stage(stage, rscript):
+    """
+    Running the stage in the current process, the R scripts in a subprocess. Returns the run time.
+    """
+    start = time.time()
+    try:
+        if stage.script.endswith('.R'):
+            subprocess.run([rscript, os.path.join(PARSERS_DIR, stage.script)] + stage.arguments,
+                           stdout=subprocess.DEVNULL if stage.quiet else None, check=True)
+        else:
+            main = load_module(stage.script).main
+            sys.argv = [stage.script] + stage.arguments
+            try:
+                main()
+            except SystemExit as e:
+                if e.code:
+                    raise RuntimeError('{} exited with {}'.format(stage.script, e.code))
+    except Exception:
+        traceback.print_exc()
+        raise
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    return time.time() - start
+
+
+def run_pipeline(stages, dependencies, state, file_hashes, jobs, rscript, force=False, dry_run=False):
+    """
+    Running the stages in dependency order, independent stages concurrently.
+    Returns the names of the failed stages and of the stages not run because of the failures.
+    """
+    stage_map = {stage.name: stage for stage in stages}
+    waiting = {stage.name: {name for name in dependencies[stage.name] if name in stage_map} for stage in stages}
+    rerun = set()
+    failed = []
+    running = {}
+
+    def start_ready_stages(executor):
+        # Skipped stages are finished at once, so the loop goes on until no stage is ready:
+        ready = [name for name, waiting_for in waiting.items() if not waiting_for]
+        while ready:
+            for name in ready:
+                stage = stage_map.pop(name)
+                del waiting[name]
+                start_stage(executor, stage)
+
+            ready = [name for name, waiting_for in waiting.items() if not waiting_for]
+
+    def start_stage(executor, stage):
+        name = stage.name
+
+        # Stages after a rerun stage are checked again once the inputs are updated (in a dry run they are rerun):
+        key = get_stage_key(stage, file_hashes)
+        if not force and not (dry_run and rerun & set(dependencies[name])) and is_up_to_date(stage, key, state, file_hashes):
+            print('[Info] Skipping {} (inputs unchanged).'.format(name), flush=True)
+            finish_stage(name)
+            return
+
+        rerun.add(name)
+        if dry_run:
+            print('[Info] Would run {}: {} {}'.format(name, stage.script, ' '.join(stage.arguments)), flush=True)
+            finish_stage(name)
+            return
+
+        print('[Info] Running {}...'.format(name), flush=True)
+        for output in stage.outputs:
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+        running[executor.submit(run_stage, stage, rscript)] = (stage, key)
+
+    def finish_stage(name):
+        for waiting_for in waiting.values():
+            waiting_for.discard(name)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        start_ready_stages(executor)
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, key = running.pop(future)
+                try:
+                    run_time = future.result()
+                except Exception as e:
+                    print('[Error] Stage {} failed: {}'.format(stage.name, e), flush=True)
+                    failed.append(stage.name)
+                    state.pop(stage.name, None)
+                    continue
+
+                print('[Info] Finished {} in {:.1f}s.'.format(stage.name, run_time), flush=True)
+                state[stage.name] = {'key': key, 'outputs': {output: file_hashes.get(output) for output in stage.outputs}}
+                finish_stage(stage.name)
+
+            # No new stages are started after a failure:
+            if not failed:
+                start_ready_stages(executor)
+
+    return failed, sorted(waiting)
+
+
+def main():
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Run the parsers as a pipeline, independent parsers in parallel.')
+
+    parser.add_argument('--files', help='Input and output files as NAME=PATH pairs, named as the Makefile variables (eg. OTEVIDENCE=raw/ot_evidence.json.gz).',
+                        required=True, nargs='+', type=str)
+    parser.add_argument('--cachedir', help='Folder of the pipeline state.', required=True, type=str)
+    parser.add_argument('-j', '--jobs', help='Number of stages running in parallel.', type=int, default=os.cpu_count())
+    parser.add_argument('-w', '--workers', help='Number of processes used by the parallel parsers.', type=int, default=1)
+    parser.add_argument('-s', '--stages', help='Stages to run (with the stages they depend on), default: all stages.', nargs='+')
+    parser.add_argument('-f', '--force', help='Run the stages even if their inputs are unchanged.', action='store_true')
+    parser.add_argument('-n', '--dryrun', help='Only print the stages that would be run.', action='store_true')
+    parser.add_argument('--rscript', help='Rscript executable.', type=str, default='Rscript')
+
+    args = parser.parse_args()
+
+    files = dict(file.split('=', 1) for file in args.files if '=' in file)
+    if len(files) < len(args.files):
+        parser.error('Files have to be given as NAME=PATH pairs.')
+
+    try:
+        stages = get_stages(files, args.workers)
+    except KeyError as e:
+        parser.error('The {} file is not given.'.format(e.args[0]))
+    dependencies = get_dependencies(stages)
+
+    if args.stages:
+        unknown = set(args.stages) - {stage.name for stage in stages}
+        if unknown:
+            parser.error('Unknown stages: {} (available: {})'.format(', '.join(sorted(unknown)), ', '.join(stage.name for stage in stages)))
+        stages = get_required_stages(stages, dependencies, args.stages)
+
+    # Inputs not produced by any stage have to exist:
+    produced = {output for stage in stages for output in stage.outputs}
+    missing = sorted({input_file for stage in stages for input_file in stage.inputs if input_file not in produced and not os.path.exists(input_file)})
+    if missing:
+        raise FileNotFoundError('Missing input files: {}'.format(', '.join(missing)))
+
+    # Reading the state of the last run:
+    state_file = os.path.join(args.cachedir, 'parser_pipeline_state.json')
+    try:
+        with open(state_file, 'rt') as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = {}
+
+    state = saved.get('stages', {})
+    file_hashes = FileHashes(saved.get('files'))
+
+    # The parsers are imported before the pool processes are started, so they are inherited where possible:
+    for stage in stages:
+        if stage.script.endswith('.py'):
+            load_module(stage.script)
+
+    start = time.time()
+    failed, not_run = run_pipeline(stages, dependencies, state, file_hashes, args.jobs, args.rscript, args.force, args.dryrun)
+
+    # The state is saved even if some stages failed, so the finished stages are not run again:
+    if not args.dryrun:
+        os.makedirs(args.cachedir, exist_ok=True)
+        temp_file = '{}.{}.tmp'.format(state_file, os.getpid())
+        with open(temp_file, 'wt') as f:
+            json.dump({'stages': state, 'files': file_hashes.cache}, f, indent=1)
+        os.replace(temp_file, state_file)
+
+    if failed:
+        print('[Error] Failed stages: {}'.format(', '.join(failed)))
+        if not_run:
+            print('[Error] Stages not run: {}'.format(', '.join(not_run)))
+        sys.exit(1)
+
+    print('[Info] Pipeline finished in {:.1f}s.'.format(time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
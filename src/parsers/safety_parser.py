@@ -1,8 +1,11 @@
 import json
-import gzip
 import pandas as pd
 import argparse
 import logging
+from id_mapping import IdMapper, get_default_index_dir
+
+# Bit flags of the safety info sources:
+SOURCE_FLAGS = {'known_target_safety': 1, 'experimental_toxicity': 2}
 
 class Safety():
 
@@ -26,84 +29,76 @@ class Safety():
         # Add ch to handler
         self._logger.addHandler(ch)
 
-        # Dictionaries for storing safety info and gene name to Ensembl id mappings
-        self.target_safety_info = {}
-        self.gene_name2ensembl_map = {}
-
-    def get_gene_name2ensembl_mappings(self, filename):
-        """Return a dictionary that maps gene names to Ensembl ids"""
+        # Table of the targets with safety info (indexed by Ensembl id):
+        self.safety_df = pd.DataFrame(columns=['name', 'safety_organs_systems_affected', 'sources'])
 
-        # Load gene info file an iterate through every gene
-        with gzip.open(filename, 'rt') as gene_file:
-            for line in gene_file:
-                gene_info_dict = json.loads(line.strip())
-                if gene_info_dict['name'] in self.gene_name2ensembl_map:
-                    self.gene_name2ensembl_map[gene_info_dict['name']].append(gene_info_dict['ensembl_id'])
-                else:
-                    self.gene_name2ensembl_map[gene_info_dict['name']] = [gene_info_dict['ensembl_id']]
+    def get_gene_name2ensembl_mappings(self, gene_names):
+        """Returns a dataframe with the Ensembl ids of the gene names"""
 
+        return self.id_mapper.map_symbol(list(gene_names)).rename(columns={'ensembl_id': 'id'})
 
     def build_json_safety(self, filename):
-        """ Read known target safety file and create dictionary with affected organs"""
+        """ Read known target safety file and create table with affected organs"""
 
         with open(filename, 'r') as known_safety:
             known_safety_data = json.load(known_safety)
-            for gene, liabilities in known_safety_data.items():
-                affected_systems = set()
-                # Targets may contain "adverse_effects" and/or "safety_risk_info"
-                for liability_type, info in liabilities.items():
-                    for effects in info:
-                        for system in effects['organs_systems_affected']:
-                            # Use mapped term unless this is an empty string, e.g. for "development", in such case use the term in the paper
-                            if system['mapped_term']:
-                                affected_systems.add(system['mapped_term'])
-                            else:
-                                self._logger.warning("The organ system \"{}\" in target {} is not mapped to uberon, using this term instead".format(system['term_in_paper'], gene))
-                                affected_systems.add(system['term_in_paper'])
-                if gene in self.gene_name2ensembl_map:
-                    for ensembl_id in self.gene_name2ensembl_map[gene]:
-                        if ensembl_id in self.target_safety_info:
-                            self.target_safety_info[ensembl_id]['safety_organs_systems_affected'].update(affected_systems)
+
+        genes = []
+        for gene, liabilities in known_safety_data.items():
+            affected_systems = set()
+            # Targets may contain "adverse_effects" and/or "safety_risk_info"
+            for liability_type, info in liabilities.items():
+                for effects in info:
+                    for system in effects['organs_systems_affected']:
+                        # Use mapped term unless this is an empty string, e.g. for "development", in such case use the term in the paper
+                        if system['mapped_term']:
+                            affected_systems.add(system['mapped_term'])
                         else:
-                            self.target_safety_info[ensembl_id] = {'name': gene,
-                                                                   'has_safety_risk': True,
-                                                                   'safety_organs_systems_affected': list(affected_systems),
-                                                                   'safety_info_source' : ["known_target_safety"]}
+                            self._logger.warning("The organ system \"{}\" in target {} is not mapped to uberon, using this term instead".format(system['term_in_paper'], gene))
+                            affected_systems.add(system['term_in_paper'])
+            genes.append((gene, affected_systems))
+
+        # Map gene names to Ensembl ids, pooling the affected organs of ids with multiple names:
+        genes_df = pd.DataFrame(genes, columns=['name', 'safety_organs_systems_affected'])
+        mapped_df = self.get_gene_name2ensembl_mappings(genes_df.name).merge(genes_df, on='name')
+        self.safety_df = mapped_df.groupby('id', sort=False).agg({
+            'name': 'first',
+            'safety_organs_systems_affected': lambda systems: set().union(*systems)
+        })
+        self.safety_df['sources'] = SOURCE_FLAGS['known_target_safety']
 
     def build_json_experimental_toxicity(self, filename):
-        """Read experimental toxicity file and output gene ids, leaving "name" and "organs_systems_affected" empty"""
-
-        experimental_toxicity_df = pd.read_csv(filename, sep='\t', header=0, index_col=0)
-        for ensembl_gene_id, info in experimental_toxicity_df.iterrows():
-            if ensembl_gene_id in self.target_safety_info:
-                if 'experimental_toxicity' not in self.target_safety_info[ensembl_gene_id]['safety_info_source']:
-                    self.target_safety_info[ensembl_gene_id]['safety_info_source'].append("experimental_toxicity")
-            else:
-                self.target_safety_info[ensembl_gene_id] = { 'has_safety_risk' : True,
-                                                             'name' : "N/A",
-                                                             'safety_organs_systems_affected' : "N/A",
-                                                             'safety_info_source' : ["experimental_toxicity"]
-                                                             }
-
-    def add_targets_without_safety_info(self, filename):
-        """Add targets without target safety information to table"""
+        """Read experimental toxicity file and add the gene ids, leaving "name" and "organs_systems_affected" empty"""
+
+        experimental_toxicity_ids = pd.read_csv(filename, sep='\t', header=0, index_col=0).index.drop_duplicates()
 
-        # Load gene info file an iterate through every gene
-        with gzip.open(filename, 'rt') as gene_file:
-            for line in gene_file:
-                gene_info_dict = json.loads(line.strip())
-                if gene_info_dict['ensembl_id'] not in self.target_safety_info:
-                    self.target_safety_info[gene_info_dict['ensembl_id']] = { 'has_safety_risk' : False,
-                                                                              'name' : "N/A",
-                                                                              'safety_organs_systems_affected' : "N/A",
-                                                                              'safety_info_source' : "N/A"
-                                                                              }
+        # Flag targets already in the table, then add the new ones:
+        is_known = self.safety_df.index.isin(experimental_toxicity_ids)
+        self.safety_df.loc[is_known, 'sources'] |= SOURCE_FLAGS['experimental_toxicity']
 
+        new_ids = experimental_toxicity_ids[~experimental_toxicity_ids.isin(self.safety_df.index)]
+        self.safety_df = pd.concat([self.safety_df, pd.DataFrame({
+            'name': 'N/A',
+            'safety_organs_systems_affected': 'N/A',
+            'sources': SOURCE_FLAGS['experimental_toxicity']
+        }, index=new_ids)])
 
-    def parse_safety(self, known_safety_file, experimental_toxicity_file , compressed_gene_file, output_filename, output_all):
+    def add_targets_without_safety_info(self):
+        """Add targets without target safety information to table"""
+
+        # The list of genes is read from the id mapping index:
+        gene_ids = pd.Index(self.id_mapper.get_genes()).drop_duplicates()
+        new_ids = gene_ids[~gene_ids.isin(self.safety_df.index)]
+        self.safety_df = pd.concat([self.safety_df, pd.DataFrame({
+            'name': 'N/A',
+            'safety_organs_systems_affected': 'N/A',
+            'sources': 0
+        }, index=new_ids)])
+
+    def parse_safety(self, known_safety_file, experimental_toxicity_file , compressed_gene_file, output_filename, output_all, index_dir=None):
 
-        # Load gene name to Ensembl id mappings
-        self.get_gene_name2ensembl_mappings(compressed_gene_file)
+        # Gene name to Ensembl id mappings
+        self.id_mapper = IdMapper(index_dir or get_default_index_dir(compressed_gene_file), ensembl_file=compressed_gene_file)
 
         # Extract needed information from known target safety file
         self.build_json_safety(known_safety_file)
@@ -115,17 +110,22 @@ class Safety():
         # This is useful to have a more readable output after integration
         if output_all:
             self._logger.info("Outputting all targets")
-            self.add_targets_without_safety_info(compressed_gene_file)
-
-        # Write to tsv file
-        safety_df = pd.DataFrame.from_dict(self.target_safety_info, orient='index', columns=['name', 'has_safety_risk', 'safety_info_source', 'safety_organs_systems_affected'])
+            self.add_targets_without_safety_info()
+
+        # Write to tsv file, the source flags and organ sets are saved in JSON format:
+        safety_df = self.safety_df
+        sources = safety_df.sources.astype(int)
+        safety_df['has_safety_risk'] = sources > 0
+        safety_df['safety_info_source'] = sources.map({
+            flags: json.dumps([source for source, flag in SOURCE_FLAGS.items() if flags & flag]) if flags else 'N/A'
+            for flags in sources.unique()
+        })
+        safety_df['safety_organs_systems_affected'] = safety_df.safety_organs_systems_affected.apply(
+            lambda x: json.dumps(list(x)) if isinstance(x, set) else x
+        )
         safety_df.index.name = "id"
 
-        # save columns in JSON format:
-        for column in ['safety_info_source', 'safety_organs_systems_affected']:
-            safety_df[column] = safety_df[column].apply(lambda x: json.dumps(x) if isinstance(x, list) else x)
-
-        safety_df.to_csv(output_filename, sep='\t')
+        safety_df[['name', 'has_safety_risk', 'safety_info_source', 'safety_organs_systems_affected']].to_csv(output_filename, sep='\t')
 
 def main():
 
@@ -146,6 +146,7 @@ def main():
     parser.add_argument('-o','--output',
                         help='Output file name',
                         type=str, default='target_safety.tsv')
+    parser.add_argument('--indexDir', help='Folder of the id mapping indexes (default: id_mapping_index folder next to the gene file)', type=str)
     parser.add_argument('-a', '--allTargets', help='Output all targets and not only the ones with safety information', action='store_true')
 
     args = parser.parse_args()
@@ -158,7 +159,7 @@ def main():
     output_all_targets = args.allTargets
 
     safety = Safety()
-    safety.parse_safety(known_safety_file, experimental_toxicity_file, gene_file, output_file, output_all_targets)
+    safety.parse_safety(known_safety_file, experimental_toxicity_file, gene_file, output_file, output_all_targets, args.indexDir)
 
 
 if __name__ == '__main__':
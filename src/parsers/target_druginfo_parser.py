@@ -2,6 +2,60 @@ import argparse
 import pandas as pd
 import numpy as np
 
+# Columns of the drug evidence table:
+EVIDENCE_COLUMNS = ["id", "disease_id", "drug_id", "phase", "moa", "drug_name"]
+
+# Entity types with a summary table:
+ENTITIES = ['target', 'drug', 'covid19_trials']
+
+def get_pair_phases(df):
+    """ Get max phase of each target-drug pair, in order of first appearance.
+    The pairs are grouped on the category codes, so pairs with missing ids (code -1) are kept"""
+
+    phases = df.phase.groupby([df.id.cat.codes, df.drug_id.cat.codes], sort=False).max()
+
+    # Codes are mapped back to the ids:
+    return pd.DataFrame({
+        'id': np.asarray(pd.Categorical.from_codes(phases.index.get_level_values(0), df.id.cat.categories), dtype=object),
+        'drug_id': np.asarray(pd.Categorical.from_codes(phases.index.get_level_values(1), df.drug_id.cat.categories), dtype=object),
+        'phase': phases.values
+    })
+
+def has_integer_phases(df):
+    """ Check if all phases are given as integers, read_csv would read such a column as int64"""
+
+    return df.phase.notnull().all() and (df.phase == np.floor(df.phase)).all()
+
+def read_drug_evidence(input_file, chunksize=None):
+    """ Read the target, drug and phase columns of the drug evidence with compact dtypes
+    and reduce them to the max phase of each target-drug pair.
+    If chunksize is set, the file is reduced chunk by chunk, so the whole table is never loaded.
+    The target and drug summaries are the same on the pairs as on the full table.
+    The phases are integers if all phases of the file are integers, floats otherwise, as read_csv reads them."""
+
+    reader = pd.read_csv(input_file, \
+                sep = "\t", \
+                names = EVIDENCE_COLUMNS, \
+                usecols = ["id", "drug_id", "phase"], \
+                dtype = {"id": "category", "drug_id": "category", "phase": "float64"}, \
+                chunksize = chunksize)
+
+    if chunksize is None:
+        integer_phases = has_integer_phases(reader)
+        pairs = get_pair_phases(reader)
+    else:
+        integer_phases = True
+        chunk_pairs = []
+        for chunk in reader:
+            integer_phases = integer_phases and has_integer_phases(chunk)
+            chunk_pairs.append(get_pair_phases(chunk))
+
+        # Pooling pairs found in multiple chunks, again on the category codes:
+        pairs = pd.concat(chunk_pairs, ignore_index=True).astype({'id': 'category', 'drug_id': 'category'})
+        pairs = get_pair_phases(pairs)
+
+    return pairs.astype({'phase': 'int64' if integer_phases else 'float64'})
+
 def get_target_druginfo(df):
     """ Get number of drugs per target and max phase"""
 
@@ -47,36 +101,59 @@ def get_toy_covid_ct_table(df):
 
     return pd.DataFrame(toy_covid_ct_list)
 
+def get_entity_info(df, entity):
+    """ Get the summary table of the entity type"""
+
+    if entity == "target":
+        result = get_target_druginfo(df)
+    elif entity == "drug":
+        result = get_drug_info(df)
+    else:
+        result = get_toy_covid_ct_table(df)
+        # Convert clinical trials phase column to an integer format that supports missing values
+        result['covid19_trial_phase'] = result['covid19_trial_phase'].astype('Int64')
+
+    return result
+
 def main():
     
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Parse information from OT drug evidence and aggregates info at the target level.')
 
     parser.add_argument('-i', '--input', help='OT drug evidence table', required=True, type=str)
-    parser.add_argument('-o', '--output', help='Output file name.', required=True, type=str)
-    parser.add_argument('-e', '--entity', help='Entity type to extract info for.', required=True, choices=['target', 'drug', 'covid19_trials'])
+    parser.add_argument('-o', '--output', help='Output file name.', type=str)
+    parser.add_argument('-e', '--entity', help='Entity type to extract info for.', choices=ENTITIES)
+    parser.add_argument('--emit', help='Entity type and output file name as entity=file, can be repeated to write multiple entities from one read of the evidence.', action='append', default=[])
+    parser.add_argument('-c', '--chunksize', help='Number of evidence lines read at once (default: the whole file).', type=int)
 
     args = parser.parse_args()
 
     # Get parameters:
     input_file = args.input
-    output_file = args.output
-    entity = args.entity
-
-    df = pd.read_csv(input_file, \
-                sep = "\t", \
-                names = ["id", "disease_id", "drug_id", "phase", "moa", "drug_name"])
-
-    if entity == "target":
-        result = get_target_druginfo(df)
-    elif entity == "drug":
-        result = get_drug_info(df)
-    else:
-        result = get_toy_covid_ct_table(df)
-        # Convert clinical trials phase column to an integer format that supports missing values
-        result['covid19_trial_phase'] = result['covid19_trial_phase'].astype('Int64')
-
-    result.to_csv(output_file, sep='\t', index=False)
+    chunksize = args.chunksize
+
+    # Entity types and output files:
+    outputs = []
+    if args.entity or args.output:
+        if not (args.entity and args.output):
+            parser.error('-e/--entity and -o/--output have to be used together.')
+        outputs.append((args.entity, args.output))
+
+    for emit in args.emit:
+        entity, _, output_file = emit.partition('=')
+        if entity not in ENTITIES or not output_file:
+            parser.error('Invalid --emit value: {} (expected entity=file, entity is one of {})'.format(emit, ', '.join(ENTITIES)))
+        outputs.append((entity, output_file))
+
+    if not outputs:
+        parser.error('Either -e/--entity with -o/--output or --emit is required.')
+
+    # Max phase of each target-drug pair:
+    df = read_drug_evidence(input_file, chunksize)
+
+    for entity, output_file in outputs:
+        result = get_entity_info(df, entity)
+        result.to_csv(output_file, sep='\t', index=False)
 
 if __name__ == '__main__':
     main()
@@ -2,26 +2,14 @@
 
 import argparse
 import json 
-import requests
 import pandas as pd 
+from ensembl_lookup import EnsemblXrefLookup
+from id_mapping import IdMapper, get_default_index_dir
 
 
-def map_primary_uniprot_accession_to_ensembl(row):
-    organism = row['organism_scientific_name'].replace(' ','_').lower()
-    accession = row['primary_accession']
-    URL = 'http://rest.ensembl.org/xrefs/symbol/{}/{}?content-type=application/json&object_type=gene'.format(
-        organism,accession)
-
-    response = requests.get(URL, verify=False).json()
-
-    if 'error' in response:
-        print('[Warning] Could not find Ensembl gene ID to {}'.format(accession))
-        return None
-    
-    try:
-        return response[0]['id'] if len(response) > 0 else None
-    except:
-        return None
+def map_primary_uniprot_accession_to_ensembl(parsed_entries_df, lookup):
+    organisms = parsed_entries_df.organism_scientific_name.str.replace(' ', '_').str.lower()
+    return lookup.map_accessions(organisms, parsed_entries_df.primary_accession)
 
 
 def main():
@@ -33,6 +21,13 @@ def main():
     parser = argparse.ArgumentParser(description='Parse uniprot .json file')
     parser.add_argument('-i','--inputfile',required=True, dest="UNIPROT_IN", type=str, help='input uniprot dat file to parse')
     parser.add_argument('-o','--outputfile',required=True, dest="UNIPROT_OUT", type=str, help='Parsed tsv file name.')
+    parser.add_argument('-m','--mappingfile', dest="MAPPING", type=str, help='Local Uniprot to Ensembl mapping file. Human accessions found in it are not looked up in Ensembl.')
+    parser.add_argument('--indexdir', dest="INDEX_DIR", type=str, help='Folder of the id mapping indexes. Default: id_mapping_index folder next to the mapping file.')
+    parser.add_argument('-c','--cachefile', dest="CACHE", type=str, help='SQLite file caching the Ensembl lookups between runs.')
+    parser.add_argument('--cachettl', dest="CACHE_TTL", type=float, default=30, help='Number of days the cached lookups are valid. Default: 30.')
+    parser.add_argument('--server', dest="SERVER", type=str, default='https://rest.ensembl.org', help='Ensembl REST server. Default: https://rest.ensembl.org')
+    parser.add_argument('-w','--workers', dest="WORKERS", type=int, default=4, help='Number of concurrent Ensembl requests. Default: 4.')
+    parser.add_argument('--allowFailedLookups', dest="ALLOW_FAILURES", action='store_true', help='Use the primary accession as id if the Ensembl lookup fails, instead of stopping.')
 
     args = parser.parse_args()
     uniprot_file = args.UNIPROT_IN
@@ -66,10 +61,13 @@ def main():
 
     # Mapping primary uniprot accessions to Ensembl gene id:
     print('[Info] Mapping primary Uniprot identifiers to Ensembl gene id...')
-    parsed_entries_df['ensembl_id'] = parsed_entries_df.apply(map_primary_uniprot_accession_to_ensembl, axis=1)
+    id_mapper = IdMapper(args.INDEX_DIR or get_default_index_dir(args.MAPPING), uniprot_map_file=args.MAPPING) if args.MAPPING else None
+    lookup = EnsemblXrefLookup(cache_file=args.CACHE, id_mapper=id_mapper, ttl_days=args.CACHE_TTL,
+                               workers=args.WORKERS, server=args.SERVER, allow_failures=args.ALLOW_FAILURES)
+    parsed_entries_df['ensembl_id'] = map_primary_uniprot_accession_to_ensembl(parsed_entries_df, lookup)
 
     # Assing ID: if gene id available use that, if not use primary accession:
-    parsed_entries_df['id'] = parsed_entries_df.apply(lambda row: row['ensembl_id'] if row['ensembl_id'] else row['primary_accession'], axis=1)
+    parsed_entries_df['id'] = parsed_entries_df.ensembl_id.where(parsed_entries_df.ensembl_id.notnull(), parsed_entries_df.primary_accession)
 
 
     # Save file: